@@ -21,7 +21,7 @@ def parse_cli():
 
 	# All input that is needed
 	parser = argparse.ArgumentParser(description="Plot 3D")
-	parser.add_argument("--file", dest="file", type=lambda x: is_valid_file(parser, x), required=True, help="CSV file to read.")
+	parser.add_argument("--file", dest="file", type=lambda x: is_valid_file(parser, x), required=True, help="Clean file to read (CSV or directory of .npy files).")
 	parser.add_argument("--from", dest="_from", type=int, default=0, help="Frame from which to plot.")
 	parser.add_argument("--to", dest="_to", type=int, default=500, help="Frame to which to plot.")
 	parser.add_argument("-v", dest="verbose", default=False, help="increase output verbosity", action="store_true")
@@ -41,13 +41,13 @@ def parse_cli():
 
 
 def main():
-	import pandas as pd
 	from mpl_toolkits import mplot3d
 	import matplotlib.pyplot as plt
+	from utility import read_clean
 
 	file, _from, _to = parse_cli()
 
-	frame = pd.read_csv(file, skiprows=range(1, _from + 1), nrows=(_to - _from + 1))
+	frame = read_clean(file, columns=["roll_x0", "roll_y0"], start=_from, stop=_to + 1)
 
 	plt.figure()
 	ax = plt.axes(projection="3d")
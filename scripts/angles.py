@@ -17,7 +17,7 @@ from pathlib import Path
 import yaml
 import numpy as np
 import pandas as pd
-from utility import HORIZONTAL_TAG, VERTICAL_TAG, HIGH_TYPE, LOW_TYPE, logger, _tag, is_valid_file, peaks_to_segments
+from utility import HORIZONTAL_TAG, VERTICAL_TAG, HIGH_TYPE, LOW_TYPE, logger, _tag, is_valid_file, peaks_to_segments, read_clean, PeakStore
 
 
 def parse_cli():
@@ -25,7 +25,7 @@ def parse_cli():
 	# All input that is needed
 	parser = argparse.ArgumentParser(description="Angles -- processes data na peak files for one experiment extracting segment info including angles")
 	parser.add_argument("-v", dest="verbose", default=False, help="increase output verbosity", action="store_true")
-	parser.add_argument("--data-file", dest="data_file", type=lambda x: is_valid_file(parser, x), required=True, help="path to a CSV data file to read.")
+	parser.add_argument("--data-file", dest="data_file", type=lambda x: is_valid_file(parser, x), required=True, help="path to a clean data file to read (CSV or directory of .npy files).")
 	parser.add_argument("--peaks-file", dest="peaks_file", type=lambda x: is_valid_file(parser, x), required=True, help="path to a YAML peaks file to read.")
 	parser.add_argument("--angles-file", dest="angles_file", type=str, required=True, help="path to a CSV angles file to write.")
 
@@ -58,14 +58,10 @@ def find_single_peaks(peaks, horizontal_segments, vertical_segments):
 
 
 def compute_segments(peaks_path):
-	peaks = {}
+	peaks = PeakStore()
 	with open(peaks_path, "r") as peaks_file:
 		try:
-			content = yaml.safe_load(peaks_file)
-			for tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
-				for type in [HIGH_TYPE, LOW_TYPE]:
-					# what we read is list, but we expect numpy array in the rest of the script
-					peaks[_tag(tag, type)] = np.array(content[_tag(tag, type)])
+			peaks = PeakStore(yaml.safe_load(peaks_file))
 		except yaml.YAMLError as exception:
 			logger.critical(exception)
 
@@ -75,16 +71,17 @@ def compute_segments(peaks_path):
 	logger.info(f"Original horizontal segments: {len(horizontal_segments)}")
 	logger.info(f"Original vertical segments: {len(vertical_segments)}")
 
-	peak_sum = 0
-	for tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
-		for type in [HIGH_TYPE, LOW_TYPE]:
-			peak_sum = peak_sum + len(peaks[_tag(tag, type)])
+	# duplicates in the peaks file count as peaks of their own, as they are not endpoints of any other segment
+	peak_sum = len(peaks) + sum(len(duplicates) for duplicates in peaks.duplicates.values())
 	if peak_sum > (len(horizontal_segments) + len(vertical_segments)) * 2:
 		logger.critical("Single peaks detected!")
 		single_peaks = find_single_peaks(peaks, horizontal_segments, vertical_segments)
 		for tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
 			if len(single_peaks[tag]) > 0:
 				logger.critical(f"{tag} single peak frames: {single_peaks[tag]}")
+			for type in [HIGH_TYPE, LOW_TYPE]:
+				if len(peaks.duplicates[_tag(tag, type)]) > 0:
+					logger.critical(f"{_tag(tag, type)} duplicate peak frames: {peaks.duplicates[_tag(tag, type)]}")
 		exit(1)
 
 	horizontal_intervals = pd.arrays.IntervalArray.from_tuples(horizontal_segments)
@@ -114,7 +111,7 @@ def main():
 
 	data_file_path, peaks_file_path, angles_file_path = parse_cli()
 
-	data_frame = pd.read_csv(data_file_path)
+	data_frame = read_clean(data_file_path, columns=[HORIZONTAL_TAG, VERTICAL_TAG])
 	segments = compute_segments(peaks_file_path)
 	angles = []
 	for segment in segments:
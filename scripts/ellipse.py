@@ -92,6 +92,115 @@ def ellipse_fit(x, y):
 		return False, {}
 
 
+def _solve_many(lhs, rhs):
+	"""
+	Solve a stack of linear systems lhs[i] * x[i] = rhs[i].
+
+	A singular system would make the whole stacked solve fail, so in that case we fall back to solving one by one.
+	Solutions of singular systems are NaN.
+	"""
+
+	try:
+		return np.linalg.solve(lhs, rhs[..., None])[..., 0]
+	except np.linalg.LinAlgError:
+		solution = np.full(rhs.shape, np.nan)
+		for i in range(len(lhs)):
+			try:
+				solution[i] = np.linalg.solve(lhs[i], rhs[i])
+			except np.linalg.LinAlgError:
+				pass
+		return solution
+
+
+def ellipse_fit_many(xs, ys):
+	"""
+	Batched version of ellipse_fit.
+
+	Takes:
+		xs: (N, K) array of x coordinates, a row of K points per ellipse
+		ys: (N, K) array of y coordinates, a row of K points per ellipse
+	Returns:
+		a boolean (N, ) mask, True where the ellipse was found
+		a dictionary with the same keys as ellipse_fit, each value an (N, ) array (NaN where the ellipse was not found)
+	"""
+	orientation_tolerance = 1e-3
+
+	xs = np.asarray(xs, dtype=np.float64)
+	ys = np.asarray(ys, dtype=np.float64)
+
+	# remove bias of the ellipse - to make matrix inversion more accurate.
+	mean_x = np.mean(xs, axis=1)
+	mean_y = np.mean(ys, axis=1)
+
+	x = xs - mean_x[:, None]
+	y = ys - mean_y[:, None]
+
+	# the estimation for the conic equation of the ellipse, a (K, 5) matrix per row
+	X = np.stack([x * x, x * y, y * y, x, y], axis=2)
+
+	# in MATLAB: a = sum(X)/(X'*X); solved for all rows at once
+	a_array = _solve_many(np.einsum("nki,nkj->nij", X, X), X.sum(axis=1))
+
+	# extract parameters from the conic equation
+	a, b, c, d, e = a_array.T
+
+	with np.errstate(divide="ignore", invalid="ignore"):
+		# remove the orientation from the ellipse (rotating by zero angle keeps the coefficients as they are)
+		rotate = np.minimum(np.abs(b / a), np.abs(b / c)) > orientation_tolerance
+		orientation_rad = np.where(rotate, 1 / 2 * np.arctan(b / (c - a)), 0)
+		cos_phi = np.cos(orientation_rad)
+		sin_phi = np.sin(orientation_rad)
+
+		a, c, d, e = [
+			a * cos_phi**2 - b * cos_phi * sin_phi + c * sin_phi**2,
+			a * sin_phi**2 + b * cos_phi * sin_phi + c * cos_phi**2,
+			d * cos_phi - e * sin_phi,
+			d * sin_phi + e * cos_phi,
+		]
+
+		mean_x, mean_y = [
+			cos_phi * mean_x - sin_phi * mean_y,
+			sin_phi * mean_x + cos_phi * mean_y,
+		]
+
+		# check if conic equation represents an ellipse
+		found = a * c > 0
+
+		# make sure coefficients are positive as required
+		negative = a < 0
+		a, c, d, e = [np.where(negative, -value, value) for value in [a, c, d, e]]
+
+		# final ellipse parameters
+		# yapf: disable
+		X0         = mean_x - d / 2 / a
+		Y0         = mean_y - e / 2 / c
+		F          = 1 + (d**2) / (4 * a) + (e**2) / (4 * c)
+		a, b       = [np.sqrt(F / a), np.sqrt(F / c)]
+		long_axis  = 2 * np.maximum(a, b)
+		short_axis = 2 * np.minimum(a, b)
+		# rotate the axes backwards to find the center point of the original TILTED ellipse
+		X0_in      = cos_phi * X0 + sin_phi * Y0
+		Y0_in      = -sin_phi * X0 + cos_phi * Y0
+
+	# pack ellipses into a structure of columns, blank out those not found
+	ellipses = {
+		'a'         : a,
+		'b'         : b,
+		'phi'       : orientation_rad,
+		'X0'        : X0,
+		'Y0'        : Y0,
+		'X0_in'     : X0_in,
+		'Y0_in'     : Y0_in,
+		'long_axis' : long_axis,
+		'short_axis': short_axis,
+	}
+	# yapf: enable
+	for key in ellipses:
+		ellipses[key] = np.where(found, ellipses[key], np.nan)
+
+	return found, ellipses
+
+
 if __name__ == "__main__":
 	print(ellipse_fit(
 		np.array([84.31013488769530, 68.53809356689450, 60.047096252441400, 63.417667388916000, 77.90740966796880]),
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Evaluates the peak detector against curated peaks across the cohort.
+
+Inputs:
+	1. Clean directory (CSV files or directories of .npy files, possibly grouped in <mouse>-clean/ directories)
+	2. Peaks directory with curated peaks files (the same layout seed-peaks.py writes)
+	3. Optionally, a grid (YAML) of detector parameters to evaluate
+Output:
+	1. Precision, recall and detection time per mouse (and for all mice) for every combination of parameters
+	2. Optionally, the same as a CSV summary
+
+Peaks are detected again for every session that has a curated peaks file, the same way seed-peaks.py detects them.
+A detected peak matches a curated peak of the same tag and type if they are at most the tolerance apart (in frames),
+every peak is matched at most once.
+"""
+
+import argparse
+import coloredlogs, logging
+import os
+from pathlib import Path
+from peaks import STD_COEFFICIENT, HEIGHT, DISTANCE, PROMINENCE, MOVING_AVG, seed_peaks
+from utility import HORIZONTAL_TAG, VERTICAL_TAG, HIGH_TYPE, LOW_TYPE, logger, _tag, is_valid_file, find_clean_sessions, read_clean_columns, PeakStore
+
+# parameters of the detector that can be put in the grid (--grid)
+GRID_PARAMETERS = ["moving_avg", "std_coefficient", "height", "distance", "prominence"]
+GRID_DEFAULTS = {"moving_avg": MOVING_AVG, "std_coefficient": STD_COEFFICIENT, "height": HEIGHT, "distance": DISTANCE, "prominence": PROMINENCE}
+# default maximal distance (in frames) between a detected and a curated peak that match
+TOLERANCE = 10
+# mouse of sessions that are not in a <mouse>-clean/ directory
+NO_MOUSE = "-"
+
+
+def parse_cli():
+
+	def is_valid_workers(parser, arg):
+		if not arg.isnumeric() or int(arg) < 1:
+			parser.error(f"Invalid value {arg}, must be a positive number")
+		return int(arg)
+
+	def is_valid_tolerance(parser, arg):
+		if not arg.isnumeric():
+			parser.error(f"Invalid value {arg}, must be a non-negative number of frames")
+		return int(arg)
+
+	# All input that is needed
+	parser = argparse.ArgumentParser(description="Evaluate peaks -- detects peaks of every curated session again and reports precision and recall per mouse, in a pool of processes")
+	parser.add_argument("-v", dest="verbose", default=False, help="increase output verbosity", action="store_true")
+	parser.add_argument("--clean-dir", dest="clean_dir", type=str, default=str(Path(__file__).parent / ".." / "clean"), help="path to the directory of clean data files to walk.")
+	parser.add_argument("--peaks-dir", dest="peaks_dir", type=str, default=str(Path(__file__).parent / ".." / "peaks"), help="path to the directory of curated peaks files.")
+	parser.add_argument("--workers", dest="workers", type=lambda x: is_valid_workers(parser, x), default=os.cpu_count(), help="Number of processes to detect peaks with. One per CPU in default")
+	parser.add_argument("--tolerance", dest="tolerance", type=lambda x: is_valid_tolerance(parser, x), default=TOLERANCE, help=f"Maximal distance in frames between a detected and a curated peak that match. {TOLERANCE} in default")
+	parser.add_argument("--grid", dest="grid", type=lambda x: is_valid_file(parser, x), default=None, help=f"YAML file with lists of detector parameter values ({', '.join(GRID_PARAMETERS)}); every combination is evaluated")
+	parser.add_argument("--summary-file", dest="summary_file", type=str, default=None, help="path to the CSV file to write the summary to.")
+
+	args = parser.parse_args()
+
+	if not Path(args.clean_dir).is_dir():
+		parser.error(f"The directory {args.clean_dir} does not exist!")
+	if not Path(args.peaks_dir).is_dir():
+		parser.error(f"The directory {args.peaks_dir} does not exist!")
+
+	# enable colored logs
+	coloredlogs.install(level=logging.DEBUG if args.verbose else logging.INFO, logger=logger)
+
+	return Path(args.clean_dir), Path(args.peaks_dir), args.workers, args.tolerance, args.grid, args.summary_file
+
+
+def read_grid(grid_file):
+	"""
+	Read the grid config (YAML) and return the list of all parameter combinations.
+
+	The config maps parameter names (GRID_PARAMETERS) to a value or a list of values.
+	Parameters missing from the config take the defaults of peaks.py.
+	"""
+	import itertools
+	import yaml
+
+	config = {}
+	if grid_file is not None:
+		with open(grid_file, "r") as config_file:
+			config = yaml.safe_load(config_file) or {}
+
+	unknown = set(config.keys()).difference(GRID_PARAMETERS)
+	if len(unknown) > 0:
+		logger.critical(f"Unknown grid parameters: {sorted(unknown)}, expected some of {GRID_PARAMETERS}")
+		exit(1)
+
+	values = []
+	for parameter in GRID_PARAMETERS:
+		value = config.get(parameter, GRID_DEFAULTS[parameter])
+		values += [value if isinstance(value, list) else [value]]
+
+	return [dict(zip(GRID_PARAMETERS, combination)) for combination in itertools.product(*values)]
+
+
+def session_mouse(data_path, clean_directory):
+	"""The mouse of the session, from its <mouse>-clean/ directory"""
+	for part in data_path.parent.relative_to(clean_directory).parts:
+		if part.endswith("-clean"):
+			return part.removesuffix("-clean")
+	return NO_MOUSE
+
+
+def match_peaks(curated, detected, tolerance):
+	"""
+	Return the number of detected peaks that match a curated peak at most tolerance frames apart.
+
+	Both arrays are sorted, so they are matched in one pass of two pointers, every peak at most once.
+	"""
+	matched = 0
+	i, j = 0, 0
+	while i < len(curated) and j < len(detected):
+		if detected[j] < curated[i] - tolerance:
+			j += 1
+		elif detected[j] > curated[i] + tolerance:
+			i += 1
+		else:
+			matched += 1
+			i += 1
+			j += 1
+
+	return matched
+
+
+def evaluate_session(data_path, peaks_path, combinations, tolerance):
+	"""Detect peaks of the session with every combination of parameters, return the counts and time of each"""
+	import time
+	import yaml
+
+	with open(peaks_path, "r") as peaks_file:
+		curated = PeakStore(yaml.safe_load(peaks_file))
+
+	# the data is read once for all combinations
+	columns = read_clean_columns(data_path, [HORIZONTAL_TAG, VERTICAL_TAG], mmap=True)
+
+	stats = []
+	for combination in combinations:
+		start = time.perf_counter()
+		detected = seed_peaks(columns, **combination)
+		seconds = time.perf_counter() - start
+
+		counts = {"curated": len(curated), "detected": 0, "matched": 0, "seconds": seconds}
+		for tag, (highs, lows) in detected.items():
+			for type, peaks in [(HIGH_TYPE, highs), (LOW_TYPE, lows)]:
+				counts["detected"] += len(peaks)
+				counts["matched"] += match_peaks(curated[_tag(tag, type)], peaks, tolerance)
+		stats += [counts]
+
+	return stats
+
+
+def summarize(rows):
+	"""Sum the counts per mouse and combination (and for all mice), and compute precision and recall"""
+	import pandas as pd
+
+	frame = pd.DataFrame(rows)
+	keys = ["mouse"] + GRID_PARAMETERS
+	counts = ["sessions", "curated", "detected", "matched", "seconds"]
+
+	frame["sessions"] = 1
+	per_mouse = frame.groupby(keys, sort=True)[counts].sum().reset_index()
+	all_mice = frame.groupby(GRID_PARAMETERS, sort=False)[counts].sum().reset_index()
+	all_mice["mouse"] = "all"
+
+	summary = pd.concat([per_mouse, all_mice[keys + counts]], ignore_index=True)
+	summary["precision"] = summary["matched"] / summary["detected"].where(summary["detected"] > 0)
+	summary["recall"] = summary["matched"] / summary["curated"].where(summary["curated"] > 0)
+
+	return summary
+
+
+def main():
+	from concurrent.futures import ProcessPoolExecutor, as_completed
+
+	clean_directory, peaks_directory, workers, tolerance, grid_file, summary_file = parse_cli()
+
+	combinations = read_grid(grid_file)
+
+	# only curated sessions can be evaluated
+	sessions = [(data_path, peaks_path) for data_path, peaks_path in find_clean_sessions(clean_directory, peaks_directory) if peaks_path.exists()]
+	if len(sessions) == 0:
+		logger.critical(f"No session of {clean_directory} has a peaks file in {peaks_directory}")
+		exit(1)
+
+	logger.info(f"Evaluating {len(sessions)} sessions with {len(combinations)} combinations of parameters, tolerance {tolerance} frames, {workers} workers")
+
+	rows = []
+	failed = 0
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(evaluate_session, data_path, peaks_path, combinations, tolerance): data_path for data_path, peaks_path in sessions}
+		for future in as_completed(futures):
+			data_path = futures[future]
+			try:
+				stats = future.result()
+			except Exception as exception:
+				logger.error(f"Could not evaluate {data_path}: {exception}")
+				failed += 1
+				continue
+
+			logger.debug(f"Evaluated {data_path}")
+			for combination, counts in zip(combinations, stats):
+				rows += [{"mouse": session_mouse(data_path, clean_directory), "session": str(data_path), **combination, **counts}]
+
+	if len(rows) > 0:
+		import pandas as pd
+
+		summary = summarize(rows)
+		with pd.option_context("display.max_rows", None, "display.width", None):
+			logger.info(f"Evaluation summary:\n{summary.to_string(index=False, float_format='{:.3f}'.format)}")
+
+		if summary_file is not None:
+			summary.to_csv(summary_file, index=False)
+			logger.info(f"Written the summary: {summary_file}")
+
+	if failed > 0:
+		logger.critical(f"{failed} sessions failed")
+		exit(1)
+
+
+if __name__ == "__main__":
+	main()
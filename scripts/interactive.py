@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
 import coloredlogs, logging
+import functools
+import glob
+import os
+import threading
+import time
 import pandas as pd
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.backend_bases import KeyEvent, MouseEvent
+from matplotlib.collections import PolyCollection
 from pathlib import Path
 import textwrap
 import yaml
-from peaks import find_peaks
-from utility import HORIZONTAL_TAG, VERTICAL_TAG, AREA_TAG, RATIO_TAG, HIGH_TYPE, LOW_TYPE, logger, _tag, is_valid_file, peaks_to_segments
+from peaks import MOVING_AVG, seed_peaks
+from utility import HORIZONTAL_TAG, VERTICAL_TAG, AREA_TAG, RATIO_TAG, HIGH_TYPE, LOW_TYPE, logger, _tag, is_valid_file, read_clean_columns, PeakStore, SegmentIndex, update_peaks_file
 
 # Constants
 KEY_CLOSE = "q"
@@ -25,10 +33,30 @@ BUTTON_RIGHT = 9
 
 # when hovering with mouse, the algorithm will look at this many frames to find something to snap to (e.g. existing peak)
 PEAK_SEARCH_DISTANCE = 50
-# the lag of the moving average
-MOVING_AVG = 10
 # initial view window size in frames
 INITIAL_WINDOW = 1000
+# moving averages are computed on demand in chunks of this many frames, and this many chunks are kept
+CHUNK_SIZE = 2**14
+CHUNK_CACHE = 64
+# envelope pyramids keep levels from this one up (bins of 2^PYRAMID_LEVEL frames), finer levels are computed from the data in view
+PYRAMID_LEVEL = 4
+# the level of bins as wide as a chunk, envelope pyramids are built chunk by chunk up to it
+CHUNK_LEVEL = CHUNK_SIZE.bit_length() - 1
+# edits of peaks are appended to the journal, next to the peaks file, and compacted into the peaks file this often (in seconds)
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_COMPACT_INTERVAL = 5
+ADD_ACTION = "add"
+REMOVE_ACTION = "remove"
+# events that can be recorded and replayed, and the percentiles of their latencies reported after a replay
+KEY_PRESS_EVENT = "key_press_event"
+KEY_RELEASE_EVENT = "key_release_event"
+MOTION_EVENT = "motion_notify_event"
+BUTTON_PRESS_EVENT = "button_press_event"
+REPLAY_PERCENTILES = [50, 90, 99]
+# keys to switch to the next and previous session, and how many loaded sessions are kept in memory
+KEY_NEXT_SESSION = "n"
+KEY_PREVIOUS_SESSION = "b"
+SESSION_CACHE = 3
 
 
 
@@ -45,6 +73,12 @@ def parse_cli():
 				./interactive.py --data-file ./clean.csv --peaks-file ./peaks.yaml -v --view-area
 				./interactive.py --data-file ./clean.csv --peaks-file ./peaks.yaml -v --view-ratio
 
+				./interactive.py --data-file ./clean.csv --peaks-file ./peaks.yaml --record ./events.yaml
+				./interactive.py --data-file ./clean.csv --peaks-file ./peaks.yaml --replay ./events.yaml
+
+				./interactive.py --sessions ./sessions.yaml -v
+				./interactive.py --sessions "./clean/*_clean.csv" --peaks-dir ./peaks -v
+
 			Keys:
 				"{KEY_CLOSE}" : close the window, save all peaks
 				"{KEY_LEFT}"/"{KEY_RIGHT}" : move zoom window left and right
@@ -53,53 +87,453 @@ def parse_cli():
 				LEFT click to add/remove HIGH peak on the currently selected frame (red dot)
 				RIGHT click to add/remove LOW peak on the currently selected frame (red dot)
 				"{KEY_UNDO}" : to add/remove last removed/added peak
+				"{KEY_NEXT_SESSION}"/"{KEY_PREVIOUS_SESSION}" : with --sessions, switch to the next/previous session (peaks of the current one are saved)
 
 			Notes:
 				At most one of --view-area and --view-ratio can be set
 				If --view-* is set, interactive marking of segments is disabled
+				--replay runs without a display: the events are sent to the plot one after another, then latencies of events are reported
+				Events are a YAML list like [{{event: key_press_event, key: right}}, {{event: motion_notify_event, frame: 300, subplot: 0}}],
+				optionally with "wait" (seconds before the event), "button" and "dblclick"
+				A --sessions manifest is a YAML list like [{{data-file: ./clean/a_clean.csv, peaks-file: ./peaks/a-peaks.yaml}}]
+				The next session is loaded in background, the last {SESSION_CACHE} sessions are kept in memory
 		"""),
 	)
-	parser.add_argument("--data-file", dest="data_file", type=lambda x: is_valid_file(parser, x), required=True, help="path to CSV data file to read")
-	parser.add_argument("--peaks-file", dest="peaks_file", type=str, required=True, help="path to YAML peaks file; if exists, will read, else will create")
+	parser.add_argument("--data-file", dest="data_file", type=lambda x: is_valid_file(parser, x), default=None, help="path to clean data file to read (CSV or directory of .npy files)")
+	parser.add_argument("--peaks-file", dest="peaks_file", type=str, default=None, help="path to YAML peaks file; if exists, will read, else will create")
+	parser.add_argument("--sessions", dest="sessions", type=str, default=None, help="instead of --data-file and --peaks-file, review many sessions: a YAML manifest of data and peaks file pairs, or a glob of clean data files")
+	parser.add_argument("--peaks-dir", dest="peaks_dir", type=str, default=None, help="with a glob of --sessions, the directory of peaks files (name-peaks.yaml for name_clean.csv)")
 	parser.add_argument("--plus-std", dest="plus_std", type=float, default=None, help="Highest peak plus 2 standard deviations")
 	parser.add_argument("--minus-std", dest="minus_std", type=float, default=None, help="Highest peak minus 2 standard deviations")
 	parser.add_argument("--view-area", dest="view_area", default=False, help="show pupil radius as a third plot; will disable marking functionality, but not zooming and walking;", action="store_true")
 	parser.add_argument("--view-ratio", dest="view_ratio", default=False, help="show pupil radii ratio as a third plot; will disable marking functionality, but not zooming and walking;", action="store_true")
+	parser.add_argument("--record", dest="record_file", type=str, default=None, help="path to YAML file to write the key, mouse move and click events of the session to, to replay them later")
+	parser.add_argument("--replay", dest="replay_file", type=lambda x: is_valid_file(parser, x), default=None, help="path to YAML file of events to replay without a display, instead of an interactive session")
+	parser.add_argument("--cache-dir", dest="cache_dir", type=str, default=str(Path(__file__).parent / ".." / "cache"), help="directory to cache peaks found for sessions with no peaks file in, seeding the same data again skips finding them")
+	parser.add_argument("--no-cache", dest="no_cache", default=False, help="do not read or write the cache of found peaks", action="store_true")
 	parser.add_argument("-v", dest="verbose", default=False, help="increase output verbosity", action="store_true")
 
 	args = parser.parse_args()
 
+	if args.sessions is None and (args.data_file is None or args.peaks_file is None):
+		parser.error("either --data-file and --peaks-file, or --sessions are required")
+	if args.sessions is not None and (args.data_file is not None or args.peaks_file is not None):
+		parser.error("--sessions cannot be used with --data-file and --peaks-file")
+
 	# enable colored logs
 	coloredlogs.install(level=logging.DEBUG if args.verbose else logging.INFO, logger=logger)
 
-	return args.data_file, args.peaks_file, args.view_area, args.view_ratio, args.plus_std, args.minus_std
+	return args.data_file, args.peaks_file, args.sessions, args.peaks_dir, args.view_area, args.view_ratio, args.plus_std, args.minus_std, args.record_file, args.replay_file, None if args.no_cache else args.cache_dir
+
+
+def journal_path(peaks_file_path):
+	"""Path to the journal of edits of the peaks file"""
+	peaks_path = Path(peaks_file_path)
+	return peaks_path.with_name(peaks_path.name + JOURNAL_SUFFIX)
 
 
-def update_peaks_file(peaks, peaks_file_path):
+def replay_journal(peaks, peaks_file_path):
 	"""
-	Write current peaks to the file given by the path.
-	Will overwrite the file if exists.
+	Apply edits from the journal of the peaks file (left by a session that did not finish) to peaks.
+
+	Returns the number of edits applied; an incomplete last line (the session stopped while writing it) is ignored.
 	"""
 
-	peaks_path = Path(peaks_file_path)
+	path = journal_path(peaks_file_path)
+	if not path.exists():
+		return 0
 
-	peaks_as_lists = {}
-	for tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
-		for type in [HIGH_TYPE, LOW_TYPE]:
-			# need to convert numpy array to list, or it will put internal structure in the file
-			peaks_as_lists[_tag(tag, type)] = peaks[_tag(tag, type)].tolist()
+	edits = 0
+	with open(path, "r", encoding="utf8") as journal:
+		for line in journal:
+			fields = line.split()
+			if not line.endswith("\n") or len(fields) != 4 or fields[0] not in [ADD_ACTION, REMOVE_ACTION] or fields[1] not in [HORIZONTAL_TAG, VERTICAL_TAG] or fields[2] not in [HIGH_TYPE, LOW_TYPE] or not fields[3].isnumeric():
+				logger.warning(f"Skipped broken journal line: {line.strip()}")
+				continue
+			action, tag, type, peak = fields
+			if action == ADD_ACTION:
+				peaks.add(tag, type, int(peak))
+			else:
+				peaks.remove(tag, type, int(peak))
+			edits += 1
 
-	with open(peaks_path, "w", encoding="utf8") as peaks_file:
-		yaml.dump(peaks_as_lists, peaks_file, default_flow_style=False, allow_unicode=True)
+	return edits
+
+
+class Prefetcher:
+	"""
+	Prepares values for keys in a background thread, before they are needed.
+
+	request() replaces the keys to prepare, get() returns the prepared value of a key or None if it is not ready.
+	take() waits for a key that is being prepared, so that a value is never prepared twice at the same time.
+	Only values of the last requested keys are kept.
+	"""
+
+	def __init__(self, prepare):
+		self.prepare = prepare
+		self.condition = threading.Condition()
+		self.pending = []
+		self.preparing = None
+		self.ready = {}
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def request(self, keys):
+		with self.condition:
+			self.ready = {key: value for key, value in self.ready.items() if key in keys}
+			self.pending = [key for key in keys if key not in self.ready and key != self.preparing]
+			self.condition.notify_all()
+
+	def get(self, key):
+		with self.condition:
+			return self.ready.get(key)
+
+	def take(self, key):
+		"""
+		Return the prepared value of the key and forget it, waiting if it is being prepared.
+
+		Returns None if the key is not prepared (or could not be), it is not prepared in background afterwards, so the caller prepares it.
+		"""
+		with self.condition:
+			if key in self.pending:
+				self.pending.remove(key)
+			while self.preparing == key:
+				self.condition.wait()
+			return self.ready.pop(key, None)
+
+	def _run(self):
+		while True:
+			with self.condition:
+				while len(self.pending) == 0:
+					self.condition.wait()
+				key = self.pending.pop(0)
+				self.preparing = key
+			try:
+				value = self.prepare(key)
+			except Exception as exception:
+				# the value will be prepared in the UI thread when needed
+				logger.debug(f"Could not prefetch {key}: {exception}")
+				value = None
+			with self.condition:
+				if value is not None:
+					self.ready[key] = value
+				self.preparing = None
+				self.condition.notify_all()
+
+
+class PeakJournal:
+	"""
+	Write-behind persistence of peaks.
 
+	Every edit is appended to the journal as a line "action tag type frame", which is cheap enough to do on every click.
+	A background thread compacts the journal every JOURNAL_COMPACT_INTERVAL seconds:
+	it writes all peaks to the peaks file, then drops the edits that the file now contains from the journal.
+	Edits are absolute (add or remove, not toggle), so replaying the journal over a peaks file that already contains some of its edits is safe.
+	"""
+
+	def __init__(self, peaks, peaks_file_path):
+		self.peaks = peaks
+		self.peaks_file_path = peaks_file_path
+		self.path = journal_path(peaks_file_path)
+		# guards peaks and the journal, shared by the UI and the compacting thread
+		self.lock = threading.Lock()
+		self.journal = open(self.path, "ab")
+		self.size = self.journal.tell()
+		self.dirty = self.size > 0
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self._run, daemon=True)
+
+	def toggle(self, tag, type, peak):
+		"""Remove the peak if exists, add otherwise, and journal the edit; return True if the peak was added"""
+		with self.lock:
+			added = self.peaks.toggle(tag, type, peak)
+			line = f"{ADD_ACTION if added else REMOVE_ACTION} {tag} {type} {peak}\n".encode("utf8")
+			self.journal.write(line)
+			self.journal.flush()
+			self.size += len(line)
+			self.dirty = True
+		return added
+
+	def compact(self):
+		"""Write all peaks to the peaks file, and keep in the journal only the edits made while writing"""
+		with self.lock:
+			if not self.dirty:
+				return
+			snapshot = PeakStore(self.peaks.to_lists())
+			position = self.size
+			self.dirty = False
+
+		update_peaks_file(snapshot, self.peaks_file_path)
+
+		with self.lock:
+			self.journal.close()
+			with open(self.path, "rb") as journal:
+				journal.seek(position)
+				tail = journal.read()
+			temporary_path = self.path.with_name(self.path.name + ".tmp")
+			with open(temporary_path, "wb") as journal:
+				journal.write(tail)
+			os.replace(temporary_path, self.path)
+			self.journal = open(self.path, "ab")
+			self.size = len(tail)
+
+		logger.debug(f"Compacted peaks journal into {self.peaks_file_path}")
+
+	def _run(self):
+		while not self.stopped.wait(JOURNAL_COMPACT_INTERVAL):
+			self.compact()
+
+	def start(self):
+		self.thread.start()
+
+	def stop(self):
+		"""Stop the compacting thread, compact the last edits and remove the (empty) journal"""
+		self.stopped.set()
+		if self.thread.is_alive():
+			self.thread.join()
+		self.compact()
+		self.journal.close()
+		if self.size == 0:
+			self.path.unlink()
+
+
+class WindowedData:
+	"""
+	Windowed access to the base columns of the clean file and to their moving averages.
+
+	Base columns are memory mapped (npy format) or read (CSV), only the columns of the tags that are shown.
+	Moving averages (half-shifted, as they are plotted) are computed on demand in chunks of CHUNK_SIZE frames,
+	from the base column with the margins that the rolling window and the shift need; the last CHUNK_CACHE chunks are kept.
+	"""
+
+	def __init__(self, path, tags):
+		self.columns = read_clean_columns(path, tags, mmap=True)
+		self.length = len(self.columns[tags[0]])
+		# computing a chunk twice (from the UI and the prefetching thread) is harmless
+		self._chunk = functools.lru_cache(maxsize=CHUNK_CACHE)(self._compute_chunk)
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, tag):
+		return self.columns[tag]
+
+	def read(self, tag, start, stop):
+		"""Frames [start, stop) of the base column of the tag"""
+		return np.asarray(self.columns[tag][max(0, start):min(self.length, stop)], dtype=np.float64)
+
+	def moving_average(self, tag, start, stop):
+		"""Frames [start, stop) of the half-shifted moving average of the tag"""
+		start, stop = max(0, start), min(self.length, stop)
+		if start >= stop:
+			return np.empty(0)
+		first = start // CHUNK_SIZE
+		values = np.concatenate([self._chunk(tag, chunk) for chunk in range(first, (stop - 1) // CHUNK_SIZE + 1)])
+		return values[start - first * CHUNK_SIZE:stop - first * CHUNK_SIZE]
+
+	def moving_average_at(self, tag, frames):
+		"""The half-shifted moving average of the tag at the frames"""
+		return np.array([self._chunk(tag, frame // CHUNK_SIZE)[frame % CHUNK_SIZE] for frame in frames], dtype=np.float64)
+
+	def _compute_chunk(self, tag, chunk):
+		shift = int(MOVING_AVG / 2)
+		start = chunk * CHUNK_SIZE
+		stop = min(self.length, start + CHUNK_SIZE)
+
+		# the shifted moving average at a frame is the mean of MOVING_AVG frames up to shift frames after it
+		left = max(0, start + shift - (MOVING_AVG - 1))
+		right = min(self.length, stop + shift)
+		mavg = pd.Series(self.read(tag, left, right)).rolling(MOVING_AVG).mean().to_numpy()
+
+		# the last frames of the series have no moving average after the shift
+		values = np.full(stop - start, np.nan)
+		count = max(0, right - shift - start)
+		values[:count] = mavg[len(mavg) - count:]
+		return values
+
+
+class Session:
+	"""
+	Everything loaded for a pair of data and peaks files: the data, envelope pyramids, peaks, snap targets and segments.
+	Envelope pyramids and snap targets are computed per chunk for the frames in view, as the moving averages are.
+
+	Also remembers the view the user left the session at.
+	Peaks are only edited while the session is open, through its journal.
+	"""
+
+	def __init__(self, data_file, peaks_file, tags, plus_std=None, minus_std=None, cache_dir=None):
+		self.data_file = data_file
+		self.peaks_file = peaks_file
+		self.plus_std = plus_std
+		self.minus_std = minus_std
+		self.left_window_endpoint = 0
+		self.window = INITIAL_WINDOW
+		self.journal = None
+
+		# only the columns that are shown are read, and only the frames in view are computed from them
+		self.data = WindowedData(data_file, tags)
+
+		# frames [start, stop) of the original data and of the moving average of a tag
+		self.readers = {}
+		for tag in tags:
+			self.readers[(tag, "data")] = functools.partial(self.data.read, tag)
+			self.readers[(tag, "mavg")] = functools.partial(self.data.moving_average, tag)
+
+		# min/max envelopes, so that zoomed out plots draw a bounded number of points
+		self.pyramids = {series: EnvelopePyramid(read, len(self.data)) for series, read in self.readers.items()}
+
+		# get all peaks
+		self.peaks = read_or_compute_peaks(self.data, peaks_file, cache_dir)
+
+		# frames to snap to on mouse hover, for every frame of the chunks hovered so far
+		self.snaps = {tag: {} for tag in [HORIZONTAL_TAG, VERTICAL_TAG]}
+
+		# segments with their colors, computed once and updated locally on every edit of peaks
+		self.segment_indices = {tag: SegmentIndex(self.peaks, tag, self.segment_color) for tag in [HORIZONTAL_TAG, VERTICAL_TAG]}
+
+	def __len__(self):
+		return len(self.data)
+
+	def segment_color(self, start, end):
+		"""Color of the segment by its angle, if the range of normal angles is given"""
+		if self.plus_std is not None:
+			angle = compute_angle_from_segment(start, end, self.data)
+			if angle < self.minus_std:
+				return "blue"
+			elif angle > self.plus_std:
+				return "red"
+		return "green"
+
+	def compute_snaps(self, tag, start, stop):
+		"""Compute the snap targets of frames [start, stop) of the tag"""
+		peak_frames = np.union1d(self.peaks.in_range(tag, HIGH_TYPE, start, stop + PEAK_SEARCH_DISTANCE), self.peaks.in_range(tag, LOW_TYPE, start, stop + PEAK_SEARCH_DISTANCE))
+		values = self.data.moving_average(tag, start, stop + PEAK_SEARCH_DISTANCE)
+		return snap_targets(values, peak_frames, start, stop, len(self.data)).astype(np.int32)
+
+	def snap(self, tag, frame):
+		"""Return the frame to snap to from the frame, the snap targets of its chunk are computed when it is hovered first"""
+		chunk = frame // CHUNK_SIZE
+		if chunk not in self.snaps[tag]:
+			self.snaps[tag][chunk] = self.compute_snaps(tag, chunk * CHUNK_SIZE, min(len(self.data), (chunk + 1) * CHUNK_SIZE))
+		return int(self.snaps[tag][chunk][frame - chunk * CHUNK_SIZE])
+
+	def update_snaps(self, tag, start, stop):
+		"""Compute the snap targets of frames [start, stop) of the tag again, in the chunks computed so far"""
+		for chunk in range(start // CHUNK_SIZE, (stop - 1) // CHUNK_SIZE + 1):
+			if chunk in self.snaps[tag]:
+				left, right = max(start, chunk * CHUNK_SIZE), min(stop, (chunk + 1) * CHUNK_SIZE)
+				self.snaps[tag][chunk][left - chunk * CHUNK_SIZE:right - chunk * CHUNK_SIZE] = self.compute_snaps(tag, left, right)
+
+	def toggle_peak(self, tag, type, peak):
+		"""Remove the peak if exists, add otherwise (journaled), and update segments and snap targets; return True if the peak was added"""
+		added = self.journal.toggle(tag, type, peak)
+		self.segment_indices[tag].update(peak)
+		# only the frames that search PEAK_SEARCH_DISTANCE frames to the right can snap to the peak
+		self.update_snaps(tag, max(0, peak - PEAK_SEARCH_DISTANCE), min(len(self.data), peak + 1))
+		return added
+
+	def open(self):
+		"""Start journaling edits, they are written to the peaks file in background"""
+		self.journal = PeakJournal(self.peaks, self.peaks_file)
+		self.journal.compact()
+		self.journal.start()
+
+	def close(self):
+		"""Write the last edits to the peaks file and stop journaling"""
+		self.journal.stop()
+		self.journal = None
+
+
+class SessionCache:
+	"""
+	Loads sessions by their index in the list of (data file, peaks file) pairs.
+
+	The SESSION_CACHE most recently used sessions are kept in memory,
+	and the session the user is likely to open next can be loaded in background (Prefetcher).
+	"""
+
+	def __init__(self, pairs, load):
+		self.pairs = pairs
+		self.load = load
+		self.sessions = collections.OrderedDict()
+		self.preloader = Prefetcher(lambda index: load(*pairs[index]))
+
+	def __len__(self):
+		return len(self.pairs)
+
+	def get(self, index):
+		if index in self.sessions:
+			self.sessions.move_to_end(index)
+			return self.sessions[index]
+
+		# a session being loaded in background is waited for, two loads of a session would race on its peaks file
+		session = self.preloader.take(index)
+		if session is None:
+			session = self.load(*self.pairs[index])
+		self.sessions[index] = session
+		while len(self.sessions) > SESSION_CACHE:
+			self.sessions.popitem(last=False)
+		return session
+
+	def preload(self, index):
+		"""Load the session in background, unless it is in memory already"""
+		self.preloader.request([index] if index not in self.sessions else [])
+
+
+def read_sessions(sessions, peaks_directory):
+	"""
+	Return the list of (data file, peaks file) pairs to review.
 
-def read_or_compute_peaks(frame, peaks_file_path):
+	sessions is either a YAML manifest, a list of {data-file: ..., peaks-file: ...},
+	or a glob of clean data files, then the peaks file of "name_clean.csv" (or "name_clean") is "name-peaks.yaml" in the peaks directory.
+	"""
+
+	if Path(sessions).is_file():
+		with open(sessions, "r") as manifest_file:
+			try:
+				manifest = yaml.safe_load(manifest_file)
+			except yaml.YAMLError as exception:
+				logger.critical(exception)
+				exit(1)
+		pairs = [(entry["data-file"], entry["peaks-file"]) for entry in manifest]
+	else:
+		if peaks_directory is None:
+			logger.critical("--peaks-dir is needed to find peaks files of a glob of sessions")
+			exit(1)
+		pairs = []
+		for data_file in sorted(glob.glob(sessions)):
+			name = Path(data_file).name.removesuffix(".csv").removesuffix("_clean")
+			pairs += [(data_file, str(Path(peaks_directory) / f"{name}-peaks.yaml"))]
+
+	for data_file, _ in pairs:
+		if not Path(data_file).exists():
+			logger.critical(f"The data file {data_file} does not exist")
+			exit(1)
+	if len(pairs) == 0:
+		logger.critical(f"No sessions found in {sessions}")
+		exit(1)
+
+	# every session keeps its own peaks and journal, sessions sharing a peaks file would overwrite each other's edits
+	data_files = collections.defaultdict(list)
+	for data_file, peaks_file in pairs:
+		data_files[Path(peaks_file).resolve()] += [data_file]
+	for peaks_file, clashing in data_files.items():
+		if len(clashing) > 1:
+			logger.critical(f"The data files {', '.join(clashing)} share the peaks file {peaks_file}, give each session its own peaks file")
+			exit(1)
+
+	return pairs
+
+
+def read_or_compute_peaks(data, peaks_file_path, cache_dir=None):
 	"""
 	Try to read peaks from file, and if file does not exist, compute them from the data.
 
 	The file is expected to be a YAML created by this script.
-	The algorithm to find the peaks from data is in a separate file.
+	The algorithm to find the peaks from data is in a separate file, peaks found before for the same data are read from the cache dir (if given).
 	Once peaks are computed, they are written in the newly created file.
+	Edits journaled by a previous session that did not finish are replayed over the peaks.
+	Returns a PeakStore.
 	"""
 
 	peaks = {}
@@ -108,19 +542,21 @@ def read_or_compute_peaks(frame, peaks_file_path):
 	if peaks_path.exists():
 		with open(peaks_path, "r") as peaks_file:
 			try:
-				content = yaml.safe_load(peaks_file)
-				for tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
-					for type in [HIGH_TYPE, LOW_TYPE]:
-						# what we read is list, but we expect numpy array in the rest of the script
-						peaks[_tag(tag, type)] = np.array(content[_tag(tag, type)])
+				peaks = PeakStore(yaml.safe_load(peaks_file))
 			except yaml.YAMLError as exception:
 				logger.critical(exception)
 	else:
-		for tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
-			for type in [HIGH_TYPE, LOW_TYPE]:
-				peaks[_tag(tag, type)] = find_peaks(frame[f"mavg_{MOVING_AVG}_{tag}"], type == HIGH_TYPE)
+		# the same as seed-peaks.py does for many sessions
+		for tag, (highs, lows) in seed_peaks({tag: data[tag] for tag in [HORIZONTAL_TAG, VERTICAL_TAG]}, cache_dir=cache_dir).items():
+			peaks[_tag(tag, HIGH_TYPE)] = highs
+			peaks[_tag(tag, LOW_TYPE)] = lows
+		peaks = PeakStore(peaks)
 		update_peaks_file(peaks, peaks_file_path)
 
+	edits = replay_journal(peaks, peaks_file_path)
+	if edits > 0:
+		logger.warning(f"Replayed {edits} edits of peaks from the journal of a previous session")
+
 	for tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
 		for type in [HIGH_TYPE, LOW_TYPE]:
 			logger.info(f"Found {len(peaks[f'{tag}_{type}'])} peaks for {f'{tag}_{type}'}")
@@ -138,13 +574,224 @@ def compute_angle_from_segment(start, end, frame):
 
 	return angle
 
+
+def bin_envelope(values, level):
+	"""Return the min and max of every bin of 2^level consecutive values (the last bin may be shorter), NaNs are ignored unless the whole bin is NaN"""
+	size = 1 << level
+	bins = np.full(-(-len(values) // size) * size, np.nan)
+	bins[:len(values)] = values
+	bins = bins.reshape(-1, size)
+	return np.fmin.reduce(bins, axis=1), np.fmax.reduce(bins, axis=1)
+
+
+def halve_envelope(mins, maxs):
+	"""Return the min and max of every pair of consecutive bins (the last bin is alone if their number is odd)"""
+	if len(mins) % 2 == 1:
+		mins = np.append(mins, np.nan)
+		maxs = np.append(maxs, np.nan)
+	return np.fmin(mins[0::2], mins[1::2]), np.fmax(maxs[0::2], maxs[1::2])
+
+
+class EnvelopePyramid:
+	"""
+	The min/max envelope pyramid of the series of length frames, read(start, stop) returns frames [start, stop) of the series.
+
+	Level k holds the min and max of every bin of 2^k consecutive frames, NaNs are ignored unless the whole bin is NaN.
+	Levels below PYRAMID_LEVEL are not kept, they are computed from the series when needed, so the pyramid takes a fraction of the memory of the series.
+	Levels up to CHUNK_LEVEL are built for a chunk of CHUNK_SIZE frames the first time its bins are needed (every bin lies within one chunk),
+	levels above combine the top bins of the chunks; so only zooming out far enough reads the whole series.
+	"""
+
+	def __init__(self, read, length):
+		self.read = read
+		self.length = length
+		# levels PYRAMID_LEVEL to CHUNK_LEVEL of every chunk built so far
+		self.chunks = {}
+
+		# up to the level with a single bin
+		self.levels = PYRAMID_LEVEL + 1
+		bins = -(-length // (1 << PYRAMID_LEVEL))
+		while bins > 1:
+			bins = -(-bins // 2)
+			self.levels += 1
+
+	def __len__(self):
+		return self.levels
+
+	def _chunk(self, chunk):
+		# building a chunk twice (from the UI and the prefetching thread) is harmless
+		if chunk not in self.chunks:
+			start = chunk * CHUNK_SIZE
+			levels = [bin_envelope(self.read(start, min(self.length, start + CHUNK_SIZE)), PYRAMID_LEVEL)]
+			while len(levels) <= CHUNK_LEVEL - PYRAMID_LEVEL:
+				levels += [halve_envelope(*levels[-1])]
+			self.chunks[chunk] = levels
+		return self.chunks[chunk]
+
+	def bins(self, level, first, last):
+		"""Return the mins and maxs of bins [first, last) of the level (PYRAMID_LEVEL or above)"""
+		last = min(last, -(-self.length // (1 << level)))
+		if first >= last:
+			return np.empty(0), np.empty(0)
+
+		if level <= CHUNK_LEVEL:
+			per_chunk = 1 << (CHUNK_LEVEL - level)
+			chunks = range(first // per_chunk, (last - 1) // per_chunk + 1)
+			offset = chunks[0] * per_chunk
+			envelopes = [self._chunk(chunk)[level - PYRAMID_LEVEL] for chunk in chunks]
+			mins = np.concatenate([mins for mins, _ in envelopes])
+			maxs = np.concatenate([maxs for _, maxs in envelopes])
+			return mins[first - offset:last - offset], maxs[first - offset:last - offset]
+
+		# every bin combines the top bins of its chunks
+		per_bin = 1 << (level - CHUNK_LEVEL)
+		tops = [self._chunk(chunk)[-1] for chunk in range(first * per_bin, min(last * per_bin, -(-self.length // CHUNK_SIZE)))]
+		mins, maxs = np.concatenate([mins for mins, _ in tops]), np.concatenate([maxs for _, maxs in tops])
+		for _ in range(level - CHUNK_LEVEL):
+			mins, maxs = halve_envelope(mins, maxs)
+		return mins, maxs
+
+
+def envelope_points(pyramid, read, left, right, frames_per_pixel):
+	"""
+	Return x and y of the points that draw frames [left, right) of the series.
+
+	Picks the coarsest level of the pyramid with bins not wider than half a pixel (so that it looks the same as the full series).
+	Above level 0, every bin is drawn as a vertical stroke from its min to its max,
+	so the number of points depends on the pixel width of the plot rather than on the number of frames.
+	"""
+	level = 0 if frames_per_pixel < 4 else min(int(np.log2(frames_per_pixel / 2)), len(pyramid) - 1)
+	if level == 0:
+		return np.arange(left, right), read(left, right)
+
+	first = left >> level
+	last = (right + (1 << level) - 1) >> level
+	if level < PYRAMID_LEVEL:
+		mins, maxs = bin_envelope(read(first << level, last << level), level)
+	else:
+		mins, maxs = pyramid.bins(level, first, last)
+
+	# x of the bin is its middle frame, both min and max are at the same x
+	xs = np.repeat(np.arange(first, last) * (1 << level) + ((1 << level) - 1) / 2, 2)
+	ys = np.column_stack([mins, maxs]).ravel()
+	return xs, ys
+
+
+def envelope_range(pyramid, read, left, right):
+	"""Return the exact min and max of frames [left, right) of the series (ignoring NaNs), combining O(log n) bins of the pyramid"""
+	size = 1 << PYRAMID_LEVEL
+	# whole bins of the first kept level within [left, right), the frames outside of them are read
+	first, last = -(-left // size), right // size
+	if first < last:
+		edges = np.concatenate([read(left, first * size), read(last * size, right)])
+	else:
+		edges, first, last = read(left, right), 0, 0
+	low, high = np.fmin.reduce(edges, initial=np.nan), np.fmax.reduce(edges, initial=np.nan)
+
+	level = PYRAMID_LEVEL
+	# first and last are in bins of the current level
+	while first < last:
+		if first % 2 == 1:
+			mins, maxs = pyramid.bins(level, first, first + 1)
+			low, high = np.fmin(low, mins[0]), np.fmax(high, maxs[0])
+			first += 1
+		if last % 2 == 1:
+			last -= 1
+			mins, maxs = pyramid.bins(level, last, last + 1)
+			low, high = np.fmin(low, mins[0]), np.fmax(high, maxs[0])
+		first //= 2
+		last //= 2
+		level += 1
+	return low, high
+
+
+def snap_targets(values, peak_frames, start, stop, length):
+	"""
+	For frames in [start, stop) of a series of length frames, return the frames to snap to.
+
+	It is the first peak within next PEAK_SEARCH_DISTANCE - 2 frames, or the first downturn (a point not below the next one) within them,
+	or the last of these frames if there is neither.
+	values are the moving average of frames [start, min(length, stop + PEAK_SEARCH_DISTANCE)), enough to see every downturn searched;
+	peak_frames are sorted peaks of any type, at least all peaks within [start, stop + PEAK_SEARCH_DISTANCE).
+	"""
+	values = np.asarray(values, dtype=np.float64)
+	frames = np.arange(start, stop)
+	searched = np.minimum(PEAK_SEARCH_DISTANCE, length - frames) - 2
+
+	downturn = np.zeros(len(values), dtype=bool)
+	downturn[:-1] = values[:-1] >= values[1:]
+	# the first downturn at or after every frame (beyond the searched frames if there is none)
+	local = np.arange(len(values))
+	next_downturn = start + np.minimum.accumulate(np.where(downturn, local, len(values))[::-1])[::-1][:stop - start]
+
+	last_searched = np.where(searched > 0, frames + searched - 1, frames)
+	targets = np.where(next_downturn < frames + searched, next_downturn, last_searched)
+
+	# the first peak at or after every frame (length if there is none)
+	next_peak = np.append(peak_frames, length).astype(np.int64)[np.searchsorted(peak_frames, frames)]
+
+	return np.where(next_peak < frames + searched, next_peak, targets)
+
+
+def read_events(events_file_path):
+	"""Read the events to replay, a YAML list recorded with --record or written by hand"""
+
+	with open(events_file_path, "r") as events_file:
+		try:
+			events = yaml.safe_load(events_file)
+		except yaml.YAMLError as exception:
+			logger.critical(exception)
+			exit(1)
+
+	for event in events:
+		if event.get("event") not in [KEY_PRESS_EVENT, KEY_RELEASE_EVENT, MOTION_EVENT, BUTTON_PRESS_EVENT]:
+			logger.critical(f"Unknown event to replay: {event}")
+			exit(1)
+
+	return events
+
+
+def replay_events(figure, events):
+	"""
+	Send the events to the handlers of the figure one after another, as if user did them.
+
+	Mouse events are at the frame (x) in the middle (y) of the subplot, so they do not depend on the size of the window.
+	Returns the latency (in seconds) of every handled event, by event name.
+	"""
+
+	latencies = {}
+	for event in events:
+		time.sleep(event.get("wait", 0))
+
+		name = event["event"]
+		if name in [KEY_PRESS_EVENT, KEY_RELEASE_EVENT]:
+			replayed = KeyEvent(name, figure.canvas, event["key"])
+		else:
+			subplot = figure.axes[event.get("subplot", 0)]
+			x, y = subplot.transData.transform((event["frame"], sum(subplot.get_ylim()) / 2))
+			replayed = MouseEvent(name, figure.canvas, x, y, button=event.get("button"), dblclick=event.get("dblclick", False))
+
+		start = time.perf_counter()
+		figure.canvas.callbacks.process(name, replayed)
+		latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+	return latencies
+
+
+def report_latencies(latencies):
+	"""Log the count and percentiles of latencies of every event"""
+	for name, values in latencies.items():
+		milliseconds = np.array(values) * 1000
+		percentiles = ", ".join(f"p{percentile} {np.percentile(milliseconds, percentile):.1f} ms" for percentile in REPLAY_PERCENTILES)
+		logger.info(f"{name}: {len(milliseconds)} events, {percentiles}, max {milliseconds.max():.1f} ms")
+
 def main():
 	"""
 	Main event loop.
 
 	The structure is roughly as follows.
-	First, the data is read from CSV file, and the peaks are read or computed.
-	Second, we define a redraw function that plots current viewpoint given selected peaks.
+	First, the data is read from clean file, and the peaks are read or computed (of the first session, if there are many).
+	Second, we create the plot and define redraw functions that update it for current viewpoint and selected peaks.
 	Third, we define event handlers that are called on keys presses, mouse clicks and mouse hover.
 	Finally, we run the plot until user exits the program.
 	"""
@@ -157,17 +804,30 @@ def main():
 	peak_selection = 0
 	# last added or removed peak (peak frame, tag, type)
 	last_peak = None
+	# incremented on every edit of peaks, so that peaks prepared in background before the edit are not shown
+	peaks_version = 0
 
 	# a variable to store a snapshot of rendered UI to be able to restore without redrawing
 	background = None
 	# a plot per tag, holds plots of actively selected frame (red dot)
 	active_peak_plots = {}
+	# plots per tag of original data and moving average series
+	data_plots = {}
+	mavg_plots = {}
+	# plots per tag, type and whether the peak is a part of a segment; and segments per tag
+	peak_plots = {}
+	segment_spans = {}
 	# a list of currently pressed keys (to track KEY_HOLD_NOT_SNAP)
 	current_pressed_keys = []
 	# current mouse x-position (need to trigger new red dot only when actual frame changes)
 	current_mouse_x = 0
+	# events of the session (to write with --record) and the time of the last one
+	recorded_events = []
+	last_event_time = time.perf_counter()
+	# the last recorded event, once its handler returns the wait before the next event starts
+	last_recorded_event = None
 
-	data_file, peaks_file, view_area, view_ratio, plus_std, minus_std = parse_cli()
+	data_file, peaks_file, sessions, peaks_dir, view_area, view_ratio, plus_std, minus_std, record_file, replay_file, cache_dir = parse_cli()
 
 	if (plus_std is None and minus_std is not None) or (plus_std is not None and minus_std is None):
 		logger.critical("Error. Check if Plus STD and Minus STD are given.")
@@ -187,119 +847,222 @@ def main():
 		extra_title = "Pupil Radii Ratio"
 		extra_y_label = "Ratio"
 
-	frame = pd.read_csv(data_file)
+	# only the columns that are shown are read
+	tags = [HORIZONTAL_TAG, VERTICAL_TAG] + ([EXTRA_TAG] if view_extra else [])
+
+	# sessions are loaded when they are opened (or in background before), the first one now
+	pairs = [(data_file, peaks_file)] if sessions is None else read_sessions(sessions, peaks_dir)
+	session_cache = SessionCache(pairs, lambda data_file, peaks_file: Session(data_file, peaks_file, tags, plus_std, minus_std, cache_dir))
+	session_index = 0
+	session = session_cache.get(session_index)
+
+	# edits are journaled on every click and written to the peaks file in background
+	session.open()
 
-	# this is important, we need a capable backend that can redraw and do bliting
-	matplotlib.use("Qt5Agg")
+	# this is important, we need a capable backend that can redraw and do bliting; a replay renders without a display
+	matplotlib.use("Qt5Agg" if replay_file is None else "Agg")
 
 	if view_extra:
 		figure, (subplot_horizontal, subplot_vertical, subplot_extra) = plt.subplots(3)
 	else:
 		figure, (subplot_horizontal, subplot_vertical) = plt.subplots(2)
 
-	# compute moving averages
-	for tag in [HORIZONTAL_TAG, VERTICAL_TAG, AREA_TAG, RATIO_TAG]:
-		frame[f"mavg_{MOVING_AVG}_{tag}"] = frame[tag].rolling(MOVING_AVG).mean()
-		frame[f"mavg_{MOVING_AVG}_{tag}_shifted"] = frame[f"mavg_{MOVING_AVG}_{tag}"].shift(-int(MOVING_AVG / 2))
+	subplots = [(HORIZONTAL_TAG, subplot_horizontal, "Horizontal", "Pixels"), (VERTICAL_TAG, subplot_vertical, "Vertical", "Pixels")]
+	if view_extra:
+		subplots += [(EXTRA_TAG, subplot_extra, extra_title, extra_y_label)]
 
-	# get all peaks
-	peaks = read_or_compute_peaks(frame, peaks_file)
+	# create the plot once, redraws only update the data of these artists
+	for tag, subplot, title, y_label in subplots:
+		(data_plots[tag], ) = subplot.plot([], [], linewidth=0.5, label="Original Sanitized Data", color="darkslategray")
+		(mavg_plots[tag], ) = subplot.plot([], [], label=f"{MOVING_AVG} moving average half-shifted", color="teal")
 
-	def redraw():
+		subplot.set_title(title)
+		subplot.set_ylabel(y_label)
+		subplot.legend()
+
+		# no need segments for tags other than vertical and horizontal
+		if tag not in [HORIZONTAL_TAG, VERTICAL_TAG]:
+			continue
+
+		# segments span the whole height of the plot, like axvspan
+		segment_spans[tag] = PolyCollection([], alpha=0.3, transform=subplot.get_xaxis_transform())
+		subplot.add_collection(segment_spans[tag], autolim=False)
+
+		# peaks that are a part of a segment are plotted differently
+		for type, color in [[HIGH_TYPE, "orange"], [LOW_TYPE, "blue"]]:
+			(peak_plots[(tag, type, True)], ) = subplot.plot([], [], "o", color=color, alpha=0.5, markersize=10)
+			(peak_plots[(tag, type, False)], ) = subplot.plot([], [], "X", color=color, alpha=0.8, markersize=10)
+
+		# empty plot for current frame (to be red dot)
+		(active_peak_plots[tag], ) = subplot.plot([], [], marker="o", color="red", alpha=0.75, animated=True, markersize=10)
+
+	def plotted_range(session, left_window_endpoint, window):
+		"""Return the frames of the session to plot: the viewable window plus wide margins"""
+		left_endpoint = max(0, left_window_endpoint - int(1.5 * window))
+		right_endpoint = min(len(session), left_window_endpoint + window + int(1.5 * window))
+		return left_endpoint, right_endpoint
+
+	def prepare_peaks(session, tag, left_endpoint, right_endpoint):
+		"""Compute segments (spans and colors) and high/low peaks (x and y of markers) of the tag of the session in the range"""
+
+		# filter only the peak in the current range
+		peaks_in_range = {}
+		for type in [HIGH_TYPE, LOW_TYPE]:
+			peaks_in_range[type] = session.peaks.in_range(tag, type, left_endpoint, right_endpoint)
+
+		# segments for current window, with colors
+		segments = session.segment_indices[tag].in_range(left_endpoint, right_endpoint)
+
+		prepared = {
+			"spans": [[(start, 0), (start, 1), (end, 1), (end, 0)] for start, end, _ in segments],
+			"colors": [segment_color for _, _, segment_color in segments],
+		}
+		for type in [HIGH_TYPE, LOW_TYPE]:
+			# extract only "tag" peaks into segment_peaks
+			segment_peaks = list(map(lambda x: x[0 if type == HIGH_TYPE else 1], segments))
+			# non_segment_peaks is set difference of all peaks minus segment_peaks
+			non_segment_peaks = np.setdiff1d(peaks_in_range[type], segment_peaks, assume_unique=True)
+			prepared[(type, True)] = (segment_peaks, session.data.moving_average_at(tag, segment_peaks))
+			prepared[(type, False)] = (non_segment_peaks, session.data.moving_average_at(tag, non_segment_peaks))
+
+		return prepared
+
+	def update_peaks(tag, prepared):
+		"""Swap prepared segments and high/low peaks of the tag into the plot"""
+		segment_spans[tag].set_verts(prepared["spans"])
+		segment_spans[tag].set_color(prepared["colors"])
+		for type in [HIGH_TYPE, LOW_TYPE]:
+			for in_segment in [True, False]:
+				peak_plots[(tag, type, in_segment)].set_data(*prepared[(type, in_segment)])
+
+	def prepare_view(view):
 		"""
-		Recreate a plot in the viewframe.
+		Compute everything the plot shows for the view (session, leftmost visible point, window size and pixel widths of subplots).
 
-		For both directions (horizontal and vertical), do this.
-		Extract data for the viewable window plus wide margins.
-		Plot original data and moving average series, high/low peaks, segments and currently selected frame marker (red dot).
+		Original data and moving average series at the level of detail of the screen, limits, and peaks and segments of both directions.
+		Only reads the data and peaks, so it can run in the background (Prefetcher) while the UI shows another view.
 		"""
+		session, left_window_endpoint, window, widths = view
+		left_endpoint, right_endpoint = plotted_range(session, left_window_endpoint, window)
 
-		nonlocal background
-		nonlocal active_peak_plots
+		prepared = {"peaks_version": peaks_version}
+		for (tag, _, _, _), width in zip(subplots, widths):
+			frames_per_pixel = window / max(1.0, width)
+			prepared[tag] = {
+				"data": envelope_points(session.pyramids[(tag, "data")], session.readers[(tag, "data")], left_endpoint, right_endpoint, frames_per_pixel),
+				"mavg": envelope_points(session.pyramids[(tag, "mavg")], session.readers[(tag, "mavg")], left_endpoint, right_endpoint, frames_per_pixel),
+				"limits": envelope_range(session.pyramids[(tag, "mavg")], session.readers[(tag, "mavg")], left_window_endpoint, min(len(session), left_window_endpoint + window)),
+			}
+			if tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
+				prepared[tag]["peaks"] = prepare_peaks(session, tag, left_endpoint, right_endpoint)
 
-		subplots = [(HORIZONTAL_TAG, subplot_horizontal, "Horizontal", "Pixels"), (VERTICAL_TAG, subplot_vertical, "Vertical", "Pixels")]
-		if view_extra:
-			subplots += [(EXTRA_TAG, subplot_extra, extra_title, extra_y_label)]
+		return prepared
 
-		for tag, subplot, title, y_label in subplots:
-			subplot.cla()
+	# prepares the views that panning left and right leads to, while the user looks at the current one
+	prefetcher = Prefetcher(prepare_view)
 
-			# compute margins for frames to plot
-			left_endpoint = max(0, current_left_window_endpoint - int(1.5 * window))
-			right_endpoint = min(len(frame.index), current_left_window_endpoint + window + int(1.5 * window))
+	def redraw():
+		"""
+		Move the plot to the current viewframe.
 
-			# plot original data and moving average series
-			subplot.plot(frame[tag][left_endpoint:right_endpoint], linewidth=0.5, label="Original Sanitized Data", color="darkslategray")
-			subplot.plot(frame[f"mavg_{MOVING_AVG}_{tag}_shifted"][left_endpoint:right_endpoint], label=f"{MOVING_AVG} moving average half-shifted", color="teal")
+		Swap the prepared view into the plot (prepared in background if the view was prefetched, or now otherwise).
+		Peaks and segments are prepared again if they changed since the view was prepared.
+		Axes change, so the whole figure is rendered.
+		Finally, request the views to the left and to the right to be prefetched.
+		"""
 
-			# set viewframe
-			subplot.set_xlim(current_left_window_endpoint, current_left_window_endpoint + window)
-			subplot.set_ylim(
-				frame[f"mavg_{MOVING_AVG}_{tag}_shifted"][current_left_window_endpoint:current_left_window_endpoint + window].min() * 0.9,
-				frame[f"mavg_{MOVING_AVG}_{tag}_shifted"][current_left_window_endpoint:current_left_window_endpoint + window].max() * 1.1,
-			)
+		nonlocal background
 
+		widths = tuple(subplot.get_window_extent().width for _, subplot, _, _ in subplots)
+		view = (session, current_left_window_endpoint, window, widths)
+		prepared = prefetcher.get(view)
+		if prepared is None:
+			prepared = prepare_view(view)
 
-			subplot.set_title(title)
-			subplot.set_ylabel(y_label)
-			subplot.legend()
+		for tag, subplot, _, _ in subplots:
+			data_plots[tag].set_data(*prepared[tag]["data"])
+			mavg_plots[tag].set_data(*prepared[tag]["mavg"])
 
-			# shortcut for non vertical and horizontal tags; no need segments for this type;
-			if tag not in [HORIZONTAL_TAG, VERTICAL_TAG]:
-				continue
+			# set viewframe
+			subplot.set_xlim(current_left_window_endpoint, current_left_window_endpoint + window)
+			low, high = prepared[tag]["limits"]
+			subplot.set_ylim(low * 0.9, high * 1.1)
 
-			# filter only the peak in the current range
-			peaks_in_range = {}
-			for type in [HIGH_TYPE, LOW_TYPE]:
-				peaks_in_range[type] = peaks[_tag(tag, type)][(peaks[_tag(tag, type)] >= left_endpoint) & (peaks[_tag(tag, type)] <= right_endpoint)]
-
-			# compute segments for current window and plot them
-			segments = peaks_to_segments(peaks_in_range[HIGH_TYPE].tolist(), peaks_in_range[LOW_TYPE].tolist())
-			for start, end in segments:
-				segment_color = "green"
-				if plus_std is not None:
-					angle = compute_angle_from_segment(start, end, frame)
-					if angle < minus_std:
-						segment_color = "blue"
-					elif angle > plus_std:
-						segment_color = "red"
-				subplot.axvspan(start, end, color=segment_color, alpha=0.3)
-
-			# plot current peaks, high and low; plot peaks that are a part of a segment differently
-			for type, color in [[HIGH_TYPE, "orange"], [LOW_TYPE, "blue"]]:
-				# extract only "tag" peaks into segment_peaks
-				segment_peaks = list(map(lambda x: x[0 if type == HIGH_TYPE else 1], segments))
-				# non_segment_peaks is set difference of all peaks minus segment_peaks
-				non_segment_peaks = np.setdiff1d(peaks_in_range[type], segment_peaks, assume_unique=True)
-				# plot these two peak types differently
-				subplot.plot(segment_peaks, frame[f"mavg_{MOVING_AVG}_{tag}_shifted"][segment_peaks], "o", color=color, alpha=0.5, markersize=10)
-				subplot.plot(non_segment_peaks, frame[f"mavg_{MOVING_AVG}_{tag}_shifted"][non_segment_peaks], "X", color=color, alpha=0.8, markersize=10)
-
-			# create empty plot for current frame (to be red dot)
-			(active_peak_plots[tag], ) = subplot.plot([], [], marker="o", color="red", alpha=0.75, animated=True, markersize=10)
+			if tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
+				if prepared["peaks_version"] != peaks_version:
+					prepared[tag]["peaks"] = prepare_peaks(session, tag, *plotted_range(session, current_left_window_endpoint, window))
+				update_peaks(tag, prepared[tag]["peaks"])
 
 		# draw and save rendered UI into variable
 		figure.canvas.draw()
 		background = figure.canvas.copy_from_bbox(figure.bbox)
 
+		# the same shifts as the left and right keys do
+		step = int(window * 0.8)
+		prefetcher.request([
+			(session, min(current_left_window_endpoint + step, len(session) - 1), window, widths),
+			(session, max(current_left_window_endpoint - step, 0), window, widths),
+		])
+
+	def redraw_peaks(tag):
+		"""
+		Update peaks and segments of the tag after they changed.
+
+		Axes do not change, so only the inside of the subplot of the tag is rendered again and blitted.
+		"""
+
+		nonlocal background
+
+		update_peaks(tag, prepare_peaks(session, tag, *plotted_range(session, current_left_window_endpoint, window)))
+
+		subplot = subplot_horizontal if tag == HORIZONTAL_TAG else subplot_vertical
+		subplot.redraw_in_frame()
+		figure.canvas.blit(subplot.bbox)
+		background = figure.canvas.copy_from_bbox(figure.bbox)
+
 	def add_or_remove_peak(peak, tag, type):
 		"""
-		A helper to update the current peaks and update the file.
+		A helper to update the current peaks and journal the edit (the file is updated in background).
 
 		Will also remember the last added or removed peak.
 		"""
 		nonlocal last_peak
+		nonlocal peaks_version
 
-		if peak in peaks[_tag(tag, type)]:
-			peak_index = np.argwhere(peaks[_tag(tag, type)] == peak)
-			peaks[_tag(tag, type)] = np.delete(peaks[_tag(tag, type)], peak_index)
-			logger.debug(f"Removed {type} peak: {peak}")
-		else:
-			peaks[_tag(tag, type)] = np.append(peaks[_tag(tag, type)], peak)
+		if session.toggle_peak(tag, type, peak):
 			logger.debug(f"Added {type} peak: {peak}")
-		# modify peaks file immediately
-		update_peaks_file(peaks, peaks_file)
+		else:
+			logger.debug(f"Removed {type} peak: {peak}")
+		peaks_version += 1
 		last_peak = (peak, tag, type)
+		redraw_peaks(tag)
+
+	def switch_session(index):
+		"""
+		Save and close the current session, and open the session at index where the user left it.
+
+		Sessions stay in memory (SessionCache), so switching back and forth does not load them again.
+		The session after the new one is loaded in background.
+		"""
+		nonlocal session
+		nonlocal session_index
+		nonlocal current_left_window_endpoint
+		nonlocal window
+		nonlocal last_peak
+
+		session.left_window_endpoint, session.window = current_left_window_endpoint, window
+		session.close()
+
+		session_index = index
+		session = session_cache.get(session_index)
+		session.open()
+		current_left_window_endpoint, window = session.left_window_endpoint, session.window
+		last_peak = None
+
+		logger.info(f"Session {session_index + 1}/{len(session_cache)}: {session.data_file}")
+		figure.canvas.manager.set_window_title(Path(session.data_file).name)
+		redraw()
+		session_cache.preload((session_index + 1) % len(session_cache))
 
 	# remove key from pressed array on release
 	def key_release_handler(event):
@@ -318,7 +1081,7 @@ def main():
 		if event.key == KEY_RIGHT:
 			# shift window right
 			current_left_window_endpoint += int(window * 0.8)
-			current_left_window_endpoint = min(current_left_window_endpoint, len(frame.index) - 1)
+			current_left_window_endpoint = min(current_left_window_endpoint, len(session) - 1)
 		elif event.key == KEY_LEFT:
 			# shift window left
 			current_left_window_endpoint -= int(window * 0.8)
@@ -330,9 +1093,17 @@ def main():
 		elif event.key == KEY_ZOOM_OUT:
 			# expand window
 			window = int(window * 2)
-			window = min(len(frame.index), window)
+			window = min(len(session), window)
 		elif event.key == KEY_UNDO:
-			add_or_remove_peak(*last_peak)
+			if last_peak is not None:
+				add_or_remove_peak(*last_peak)
+			return
+		elif event.key in [KEY_NEXT_SESSION, KEY_PREVIOUS_SESSION]:
+			if len(session_cache) > 1:
+				switch_session((session_index + (1 if event.key == KEY_NEXT_SESSION else -1)) % len(session_cache))
+			return
+		else:
+			return
 		redraw()
 
 	# invoke on mouse movement
@@ -344,30 +1115,14 @@ def main():
 			"""
 			Return the active frame for the location.
 
-			Go right PEAK_SEARCH_DISTANCE until either peak found, or a downturn.
+			Go right PEAK_SEARCH_DISTANCE until either peak found, or a downturn (precomputed for every frame).
 			"""
 
-			peak = current
 			# don't snap if KEY_HOLD_NOT_SNAP is pressed
-			if KEY_HOLD_NOT_SNAP in current_pressed_keys:
-				return peak
-
-			# get next PEAK_SEARCH_DISTANCE points
-			points = frame[f"mavg_{MOVING_AVG}_{tag}_shifted"][current:min(len(frame.index), current + PEAK_SEARCH_DISTANCE)].tolist()
+			if KEY_HOLD_NOT_SNAP in current_pressed_keys or not 0 <= current < len(session):
+				return current
 
-			# if found peak, snap to it
-			for x in range(0, len(points) - 2):
-				peak = x + current
-				if peak in peaks[_tag(tag, HIGH_TYPE)] or peak in peaks[_tag(tag, LOW_TYPE)]:
-					return peak
-
-			# if found downturn, snap to it
-			for x in range(0, len(points) - 2):
-				peak = x + current
-				if points[x] >= points[x + 1]:
-					return peak
-
-			return peak
+			return session.snap(tag, current)
 
 		for tag, subplot in [[HORIZONTAL_TAG, subplot_horizontal], [VERTICAL_TAG, subplot_vertical]]:
 			# if mouse is within plot canvas
@@ -381,8 +1136,8 @@ def main():
 					peak_selection = compute_nearest_peak(tag, int(event.xdata))
 
 					# modify existing peak selection plot, set marker
-					active_peak_plots[tag].set_data([peak_selection], [frame[f"mavg_{MOVING_AVG}_{tag}_shifted"][peak_selection]])
-					if peak_selection in peaks[_tag(tag, HIGH_TYPE)] or peak_selection in peaks[_tag(tag, LOW_TYPE)]:
+					active_peak_plots[tag].set_data([peak_selection], session.data.moving_average_at(tag, [peak_selection]))
+					if session.peaks.is_peak(tag, peak_selection):
 						active_peak_plots[tag].set(marker="x")
 					else:
 						active_peak_plots[tag].set(marker="o")
@@ -407,7 +1162,7 @@ def main():
 				if KEY_HOLD_NOT_SNAP in current_pressed_keys:
 					# expand window
 					window = int(window * 2)
-					window = min(len(frame.index), window)
+					window = min(len(session), window)
 				else:
 					# shrink window
 					window = int(window / 2)
@@ -415,7 +1170,7 @@ def main():
 			if event.button == BUTTON_RIGHT:
 				# shift window right
 				current_left_window_endpoint += int(window * 0.8)
-				current_left_window_endpoint = min(current_left_window_endpoint, len(frame.index) - 1)
+				current_left_window_endpoint = min(current_left_window_endpoint, len(session) - 1)
 			elif event.button == BUTTON_LEFT:
 				# shift window left
 				current_left_window_endpoint -= int(window * 0.8)
@@ -430,19 +1185,81 @@ def main():
 								# if existing peak selected, remove it, otherwise, add
 								add_or_remove_peak(peak_selection, tag, type)
 								break
+				# peaks are redrawn by themselves, the view did not change
+				return
 			redraw()
 
+	# remember every event in the form read_events expects, mouse events by frame and subplot
+	def record_handler(event):
+		nonlocal last_event_time, last_recorded_event
+
+		recorded = {"event": event.name}
+		if event.name in [KEY_PRESS_EVENT, KEY_RELEASE_EVENT]:
+			recorded["key"] = event.key
+		elif event.inaxes is not None:
+			recorded["frame"] = float(event.xdata)
+			recorded["subplot"] = figure.axes.index(event.inaxes)
+			if event.name == BUTTON_PRESS_EVENT:
+				recorded["button"] = int(event.button)
+				recorded["dblclick"] = event.dblclick
+		else:
+			return
+
+		now = time.perf_counter()
+		recorded["wait"] = round(now - last_event_time, 3)
+		last_event_time = now
+		recorded_events.append(recorded)
+		last_recorded_event = event
+
+	def recorded_handler(handler):
+		"""With --record, the wait before the next event starts once the handler of a recorded event returns (replay runs the handler again)"""
+		if record_file is None:
+			return handler
+
+		def handle(event):
+			nonlocal last_event_time
+			handler(event)
+			if last_recorded_event is event:
+				last_event_time = time.perf_counter()
+
+		return handle
+
 	# register event listeners
-	figure.canvas.mpl_connect("key_press_event", key_press_handler)
+	if record_file is not None:
+		for name in [KEY_PRESS_EVENT, KEY_RELEASE_EVENT, MOTION_EVENT, BUTTON_PRESS_EVENT]:
+			figure.canvas.mpl_connect(name, record_handler)
+	figure.canvas.mpl_connect("key_press_event", recorded_handler(key_press_handler))
 	figure.canvas.mpl_connect("resize_event", lambda event: redraw())
 	if not view_extra:
-		figure.canvas.mpl_connect("motion_notify_event", motion_notify_handler)
-		figure.canvas.mpl_connect("key_release_event", key_release_handler)
-		figure.canvas.mpl_connect("button_press_event", on_click_handler)
+		figure.canvas.mpl_connect("motion_notify_event", recorded_handler(motion_notify_handler))
+		figure.canvas.mpl_connect("key_release_event", recorded_handler(key_release_handler))
+		figure.canvas.mpl_connect("button_press_event", recorded_handler(on_click_handler))
 
+	figure.canvas.manager.set_window_title(Path(session.data_file).name)
 	redraw()
 
-	plt.show()
+	# the next session is loaded while the user works on the first one
+	if len(session_cache) > 1:
+		session_cache.preload(1)
+
+	if replay_file is None:
+		plt.show()
+	else:
+		report_latencies(replay_events(figure, read_events(replay_file)))
+
+	# write the last edits to the peaks file
+	session.close()
+
+	if replay_file is not None:
+		for tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
+			for type in [HIGH_TYPE, LOW_TYPE]:
+				logger.info(f"{len(session.peaks[_tag(tag, type)])} peaks for {_tag(tag, type)}")
+		logger.info(f"Peaks written to {session.peaks_file}")
+
+	if record_file is not None:
+		with open(record_file, "w", encoding="utf8") as events_file:
+			yaml.dump(recorded_events, events_file, default_flow_style=None, sort_keys=False)
+		logger.info(f"Recorded {len(recorded_events)} events to {record_file}")
 
 
 if __name__ == "__main__":
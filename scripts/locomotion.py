@@ -17,16 +17,14 @@ import os
 import logging
 from pathlib import Path
 from tqdm import tqdm
-from utility import is_valid_file
+from utility import is_valid_file, read_dlc_csv
 import matplotlib.pyplot as plt
 
 FRAME_RATE = 60
 KEEP_SECONDS = 900
 
-C_LEFT_PAW_X = 1
-C_LEFT_LIKELIHOOD = 3
-C_RIGHT_PAW_X = 7
-C_RIGHT_LIKELIHOOD = 9
+LEFT_PAW = "left-paw"
+RIGHT_PAW = "right-paw"
 
 LIKELIHOOD_THRESHOLD = 0.99
 X_PERCENTILE = 0.99
@@ -74,23 +72,18 @@ def main():
 	# Parse the CSV files.
 	file, category_file = parse_cli()
 	
-	frame = pd.read_csv(file, header=2)
+	# Read only x and likelihood of the paws, and keep only the first 15 minutes.
+	data = read_dlc_csv(file, bodyparts=[LEFT_PAW, RIGHT_PAW], coords=["x", "likelihood"], nrows=KEEP_SECONDS * FRAME_RATE + 1)
+	frame = pd.DataFrame(data["x"], columns=[LEFT_PAW, RIGHT_PAW])
 
-	logging.info(f"Parsed CSV (n = {len(frame.index)})")
-
-	# Truncate the data to keep only the first 15 minutes.
-	frame = frame.truncate(after=KEEP_SECONDS * FRAME_RATE)
-
-	logging.info(f"Truncated frame (n = {len(frame.index)})")
+	logging.info(f"Parsed CSV, first {KEEP_SECONDS} seconds (n = {len(frame.index)})")
 
 	# Process the data, setting low-likelihood points to NaN and removing high data higher than threshold percentile.
-	for c_likelihood, c_paw_x in [(C_LEFT_LIKELIHOOD, C_LEFT_PAW_X), (C_RIGHT_LIKELIHOOD, C_RIGHT_PAW_X)]:
-		logging.info(f"C Likelihood is {c_likelihood}")
-		logging.info(f"C Paw is {c_paw_x}")
-		tmp = (frame.iloc [:, c_likelihood] < LIKELIHOOD_THRESHOLD)
-		frame.iloc[tmp, c_paw_x] = np.nan
+	for i, paw in enumerate([LEFT_PAW, RIGHT_PAW]):
+		logging.info(f"Paw is {paw}")
+		frame.loc[data["likelihood"][:, i] < LIKELIHOOD_THRESHOLD, paw] = np.nan
 
-		frame.iloc[(frame.iloc[:, c_paw_x] > frame.iloc[:, c_paw_x].quantile(X_PERCENTILE)), c_paw_x] = np.nan
+		frame.loc[frame[paw] > frame[paw].quantile(X_PERCENTILE), paw] = np.nan
 
 	frame.interpolate(inplace=True)
 
@@ -102,8 +95,8 @@ def main():
 		while current + WINDOW < len(frame.index):
 			subframe = frame.iloc[current:current + WINDOW, :]
 
-			diff_left = subframe.iloc[:, C_LEFT_PAW_X].max() - subframe.iloc[:, C_LEFT_PAW_X].min()
-			diff_right = subframe.iloc[:, C_RIGHT_PAW_X].max() - subframe.iloc[:, C_RIGHT_PAW_X].min()
+			diff_left = subframe[LEFT_PAW].max() - subframe[LEFT_PAW].min()
+			diff_right = subframe[RIGHT_PAW].max() - subframe[RIGHT_PAW].min()
 
 			if diff_left >= DIFF_THRESHOLD or diff_right >= DIFF_THRESHOLD:
 				logging.debug(f"Window [{current} : {current+WINDOW}] MOVEMENT")
@@ -141,8 +134,8 @@ def main():
 
 		logging.info(f"Percentage of switches during locomotion: {percentage_during_movement}%")
 
-	ax = frame.iloc[:, C_LEFT_PAW_X].plot(label="Left Paw")
-	frame.iloc[:, C_RIGHT_PAW_X].plot(ax=ax, label="Right Paw")
+	ax = frame[LEFT_PAW].plot(label="Left Paw")
+	frame[RIGHT_PAW].plot(ax=ax, label="Right Paw")
 	#[plt.axvline(start/5, linewidth=1, color='r') for start in category_frame["start"]]			#if Category_file is not None -- uncomment
 	plt.xlabel("Frames")
 	plt.ylabel("Pixels")
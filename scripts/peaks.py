@@ -1,9 +1,60 @@
 # designed to be included in other programs
 
+import os
 import scipy.signal as signal
 import numpy as np
+import pandas as pd
+from pathlib import Path
+from utility import CACHE_BYTES, evict_cache
 
 STD_COEFFICIENT = 2
+# arguments of scipy find_peaks: minimal height and prominence, and minimal distance between peaks (in frames)
+HEIGHT = 2
+DISTANCE = 200
+PROMINENCE = 2
+# the lag of the moving average peaks are found on (interactive.py plots the same)
+MOVING_AVG = 10
+# a peak is kept if the mean of this many points after it is above the mean of this many points before it
+MEAN_WINDOW = 50
+# frames after a peak LivePeaks waits for before the peak is final (at least distance + MEAN_WINDOW),
+# the series needs to fall by the prominence after a peak, which takes up to about 600 frames in our recordings
+LIVE_LOOKAHEAD = 1000
+# frames of the smoothed series LivePeaks keeps to find peaks in (at least 4 look-aheads)
+LIVE_BUFFER = 2**13
+
+
+def _window_means(values, starts, length):
+	"""
+	Return the means of values[start:start + length] for every start, ignoring NaNs (NaN if all are NaN).
+
+	All means come from one cumulative sum (and one cumulative count of non-NaN values) instead of a slice per window.
+	"""
+	missing = np.isnan(values)
+	sums = np.concatenate([[0.0], np.cumsum(np.where(missing, 0.0, values))])
+	counts = np.concatenate([[0], np.cumsum(~missing)])
+
+	stops = starts + length
+	count = counts[stops] - counts[starts]
+	with np.errstate(invalid="ignore", divide="ignore"):
+		return np.where(count > 0, (sums[stops] - sums[starts]) / count, np.nan)
+
+
+def _filter_peaks(std_series, peaks):
+	"""Keep the peaks near the ends of the series, and the peaks after which the series is higher on average than before them"""
+	values = np.asarray(std_series, dtype=np.float64)
+	peaks = np.asarray(peaks, dtype=np.int64)
+
+	inner = (peaks >= MEAN_WINDOW) & (peaks <= len(values) - MEAN_WINDOW)
+	left_means = _window_means(values, peaks[inner] - MEAN_WINDOW, MEAN_WINDOW)
+	right_means = _window_means(values, peaks[inner], MEAN_WINDOW)
+
+	keep = ~inner
+	keep[inner] = right_means > left_means
+	return peaks[keep]
+
+
+def _find_peaks(std_series, height=HEIGHT, distance=DISTANCE, prominence=PROMINENCE):
+	return _filter_peaks(std_series, signal.find_peaks(std_series, height=height, distance=distance, prominence=prominence)[0])
 
 
 def find_peaks(series, high=True):
@@ -20,16 +71,180 @@ def find_peaks(series, high=True):
 	else:
 		std_series = 200 - (series - series.rolling(5).std() * STD_COEFFICIENT)
 
-	peaks = signal.find_peaks(std_series, height=2, distance=200, prominence=2)[0]
+	return _find_peaks(std_series)
+
+
+def find_all_peaks(frame, std_coefficient=STD_COEFFICIENT, height=HEIGHT, distance=DISTANCE, prominence=PROMINENCE):
+	"""
+	Takes:
+		frame: a data frame (or a dict) of series of the same length by tag (e.g. x0 and y0), already smoothed with moving average
+		std_coefficient, height, distance, prominence: parameters of the detector (constants of this file in default)
+	Returns:
+		a dict with a pair of numpy arrays of high and low peaks by tag, the same as find_peaks gives for every series
+
+	The rolling standard deviation is computed for all series at once, and shared by high and low peaks.
+	"""
+
+	frame = pd.DataFrame(frame)
+	stds = frame.rolling(5).std() * std_coefficient
+
+	peaks = {}
+	for tag in frame.columns:
+		highs = _find_peaks(frame[tag] + stds[tag], height, distance, prominence)
+		lows = _find_peaks(200 - (frame[tag] - stds[tag]), height, distance, prominence)
+		peaks[tag] = (highs, lows)
+
+	return peaks
+
+
+def seed_peaks(columns, moving_avg=MOVING_AVG, cache_dir=None, **parameters):
+	"""
+	Takes:
+		columns: a dict of raw series (numpy arrays or series, e.g. x0 and y0 of a clean file) by tag
+		moving_avg: the lag of the moving average to smooth the series with
+		cache_dir: a directory to cache the peaks in, keyed by the content of the series and all parameters (no cache if None)
+		parameters: other parameters of the detector, as find_all_peaks takes them
+	Returns:
+		a dict with a pair of numpy arrays of high and low peaks by tag, the initial peaks of a session before it is curated
+	"""
+
+	if cache_dir is None:
+		return find_all_peaks(pd.DataFrame(columns).rolling(moving_avg).mean(), **parameters)
+
+	cache_path = peaks_cache_path(cache_dir, columns, moving_avg, parameters)
+	peaks = read_peaks_cache(cache_path, list(columns))
+	if peaks is None:
+		peaks = find_all_peaks(pd.DataFrame(columns).rolling(moving_avg).mean(), **parameters)
+		write_peaks_cache(cache_path, peaks)
+
+	return peaks
+
+
+def peaks_cache_path(cache_dir, columns, moving_avg, parameters):
+	"""
+	Return the path to the cached peaks of the series.
+
+	The key is the hash of the values of every series together with the smoothing lag and all detector parameters (defaults included).
+	"""
+	import hashlib
+
+	parameters = {"std_coefficient": STD_COEFFICIENT, "height": HEIGHT, "distance": DISTANCE, "prominence": PROMINENCE, **parameters}
+
+	digest = hashlib.sha256()
+	for tag, values in columns.items():
+		digest.update(f"{tag};".encode())
+		digest.update(np.ascontiguousarray(values, dtype=np.float64))
+	digest.update(f"moving_avg={moving_avg};mean_window={MEAN_WINDOW};".encode())
+	digest.update("".join(f"{name}={value};" for name, value in sorted(parameters.items())).encode())
+
+	return Path(cache_dir) / f"{digest.hexdigest()[:32]}-peaks.npz"
+
+
+def read_peaks_cache(cache_path, tags):
+	"""Return the cached peaks (as find_all_peaks returns them) of the tags, or None if they are not cached"""
+	try:
+		with np.load(cache_path) as cached:
+			peaks = {tag: (cached[f"{tag}_high"], cached[f"{tag}_low"]) for tag in tags}
+		# the modification time orders the entries for eviction
+		os.utime(cache_path)
+	except (OSError, KeyError, ValueError):
+		# missing, or removed by another process meanwhile
+		return None
+
+	return peaks
+
+
+def write_peaks_cache(cache_path, peaks, max_bytes=CACHE_BYTES):
+	"""Write the peaks to the cache, replacing the file atomically, and remove the least recently used entries of the cache above max_bytes"""
+	cache_path = Path(cache_path)
+	cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+	temporary_path = cache_path.with_suffix(".tmp")
+	with open(temporary_path, "wb") as cache_file:
+		np.savez(cache_file, **{f"{tag}_{type}": values for tag, (highs, lows) in peaks.items() for type, values in [("high", highs), ("low", lows)]})
+	os.replace(temporary_path, cache_path)
+
+	evict_cache(cache_path.parent, [cache_path], max_bytes)
+
+
+class LivePeaks:
+	"""
+	Finds peaks of series that grow during recording, the same way seed_peaks finds them in whole series.
+
+	The moving average and the rolling standard deviation are updated with the new values only (the last values carry over),
+	and the smoothed series is kept in a buffer of the last frames only, so memory does not grow with the recording.
+	Peaks are searched for in the buffer, and a peak is final once the look-ahead after it has come:
+	a higher peak up to distance frames later may remove it, the filter needs MEAN_WINDOW frames after it,
+	and its prominence is only reached once the series falls after it.
+	Prominence is measured within the buffer and the look-ahead, so a peak may be missed if its bases are farther away.
+	"""
+
+	def __init__(self, tags, moving_avg=MOVING_AVG, std_coefficient=STD_COEFFICIENT, height=HEIGHT, distance=DISTANCE, prominence=PROMINENCE, lookahead=LIVE_LOOKAHEAD, buffer=LIVE_BUFFER):
+		self.moving_avg = moving_avg
+		self.std_coefficient = std_coefficient
+		self.parameters = (height, distance, prominence)
+		self.lookahead = max(lookahead, distance + MEAN_WINDOW)
+		self.buffer = max(buffer, 4 * self.lookahead)
+
+		# number of frames seen, and the frame before which all peaks are final
+		self.length = 0
+		self.confirmed = 0
+
+		# raw values the moving average and the standard deviation of the next frame depend on
+		self.tails = {tag: np.empty(0) for tag in tags}
+		# smoothed series of high and low peaks (as find_all_peaks makes them) of the last frames
+		self.series = {(tag, high): np.empty(0) for tag in tags for high in [True, False]}
+
+	def update(self, columns):
+		"""
+		Takes:
+			columns: a dict of new raw values (numpy arrays of the same length) by tag, the frames right after the ones given before
+		Returns:
+			a dict with a pair of numpy arrays of high and low peaks (frame numbers) by tag, the peaks that became final
+		"""
+
+		peaks = {tag: ([np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]) for tag in self.tails}
+
+		# the buffer must keep a look-ahead of context before the frames confirmed with every part
+		length = len(next(iter(columns.values())))
+		for start in range(0, length, self.buffer // 2):
+			self._append({tag: np.asarray(values[start:start + self.buffer // 2], dtype=np.float64) for tag, values in columns.items()})
+			self._confirm(self.length - self.lookahead, peaks)
+
+		return {tag: (np.concatenate(highs), np.concatenate(lows)) for tag, (highs, lows) in peaks.items()}
+
+	def flush(self):
+		"""Return the peaks (as update does) that are left once the series are complete, the end of the buffer is the end of the series then"""
+
+		peaks = {tag: ([np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]) for tag in self.tails}
+		self._confirm(self.length, peaks)
+
+		return {tag: (np.concatenate(highs), np.concatenate(lows)) for tag, (highs, lows) in peaks.items()}
+
+	def _append(self, columns):
+		for tag, values in columns.items():
+			# the first new frame needs moving_avg - 1 earlier values for its average, and 4 earlier averages for its deviation
+			values = np.concatenate([self.tails[tag], values])
+			self.tails[tag] = values[-(self.moving_avg + 3):]
+
+			averages = pd.Series(values).rolling(self.moving_avg).mean()
+			stds = averages.rolling(5).std() * self.std_coefficient
+			averages, stds = averages.to_numpy()[-len(columns[tag]):], stds.to_numpy()[-len(columns[tag]):]
+
+			for high, series in [(True, averages + stds), (False, 200 - (averages - stds))]:
+				self.series[(tag, high)] = np.concatenate([self.series[(tag, high)], series])[-self.buffer:]
+
+		self.length += len(next(iter(columns.values())))
+
+	def _confirm(self, boundary, peaks):
+		"""Add the peaks of frames [confirmed, boundary) to the lists of peaks by tag"""
+		if boundary <= self.confirmed:
+			return
 
-	new_peaks = []
-	for peak in peaks:
-		if peak < 50 or peak > len(std_series) - 50:
-			new_peaks += [peak]
-			continue
-		left_mean = std_series[peak - 50:peak].mean()
-		right_mean = std_series[peak:peak + 50].mean()
-		if right_mean > left_mean:
-			new_peaks += [peak]
+		for tag in self.tails:
+			for high in [True, False]:
+				series = self.series[(tag, high)]
+				found = _find_peaks(series, *self.parameters) + (self.length - len(series))
+				peaks[tag][0 if high else 1].append(found[(found >= self.confirmed) & (found < boundary)])
 
-	return np.array(new_peaks)
+		self.confirmed = boundary
@@ -2,7 +2,8 @@
 
 import os
 import logging
-from utility import is_valid_file
+from pathlib import Path
+from utility import is_valid_file, read_clean
 
 
 def parse_cli():
@@ -10,8 +11,10 @@ def parse_cli():
 
 	# All input that is needed
 	parser = argparse.ArgumentParser(description="Plot (Plots sanitized data)")
-	parser.add_argument("--file_path", dest="file_path", type=lambda x: is_valid_file(parser, x), required=True, help="Path to the clean CSV file to read.")
+	parser.add_argument("--file_path", dest="file_path", type=lambda x: is_valid_file(parser, x), required=True, help="Path to the clean file to read (CSV or directory of .npy files).")
 	parser.add_argument("--rolling", dest="rolling", type=int, default=10, help="Rolling mead value")
+	parser.add_argument("--cache-dir", dest="cache_dir", type=str, default=str(Path(__file__).parent / ".." / "cache"), help="Directory to cache found peaks in, re-plotting the same file skips finding them")
+	parser.add_argument("--no-cache", dest="no_cache", default=False, help="Do not read or write the cache of found peaks", action="store_true")
 	parser.add_argument("-v", dest="verbose", default=False, help="increase output verbosity", action="store_true")
 
 	args = parser.parse_args()
@@ -22,28 +25,29 @@ def parse_cli():
 		datefmt='%a, %d %b %Y %H:%M:%S',
 	)
 
-	return args.file_path, args.rolling
+	return args.file_path, args.rolling, None if args.no_cache else args.cache_dir
 
 
 def main():
-	import pandas as pd
 	import matplotlib.pyplot as plt
-	from peaks import find_peaks
+	from peaks import seed_peaks
 	import matplotlib.colors as mcolors
 
-	file_path, rolling = parse_cli()
+	file_path, rolling, cache_dir = parse_cli()
 
-	frame = pd.read_csv(file_path)
+	frame = read_clean(file_path, columns=["x0", "y0", "ellipse_area", "roll_ellipse_area"])
 
 	fig, (ax_horizontal, ax_vertical, ax3) = plt.subplots(3, sharex=True)
 
+	# rolling means to smooth the plot, high and low peaks of both are found at once (on the same means) or read from the cache
+	rolling_means = frame[["x0", "y0"]].rolling(20).mean()
+	all_peaks = seed_peaks({column: frame[column].to_numpy() for column in ["x0", "y0"]}, moving_avg=20, cache_dir=cache_dir)
+
 	def plot_peaks(column_name, plot_name, ax):
-		rolling_mean = frame[column_name].rolling(20).mean()  # rolling mean to smooth the plot
+		rolling_mean = rolling_means[column_name]
 
-		peaks = find_peaks(rolling_mean, high=True)
+		peaks, peaks_low = all_peaks[column_name]
 		print(len(peaks))
-
-		peaks_low = find_peaks(rolling_mean, high=False)
 		print(len(peaks_low))
 
 		ax.set_title(f"{plot_name} Movements")
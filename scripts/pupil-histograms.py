@@ -4,8 +4,7 @@ import argparse
 import coloredlogs, logging
 from pathlib import Path
 import numpy as np
-import pandas as pd
-from utility import logger, is_valid_file
+from utility import logger, is_valid_file, read_clean
 import matplotlib.pyplot as plt
 import statsmodels.api as sm
 import scipy.signal as signal
@@ -18,7 +17,7 @@ def parse_cli():
 	parser = argparse.ArgumentParser(description="Histograms -- plot a single or double histogram")
 	parser.add_argument("-v", dest="verbose", default=False, help="increase output verbosity", action="store_true")
 	parser.add_argument("--bins", dest="bins", type=int, default=20, help="The number of bins for the histogram.")
-	parser.add_argument("--clean-file", dest="clean_file", type=lambda x: is_valid_file(parser, x), required=True, help="path to a Clean CSV file to read (if supplied, will plot pupils area).")
+	parser.add_argument("--clean-file", dest="clean_file", type=lambda x: is_valid_file(parser, x), required=True, help="path to a Clean file to read, CSV or directory of .npy files (if supplied, will plot pupils area).")
 
 	args = parser.parse_args()
 
@@ -32,7 +31,7 @@ def main():
 
 	clean_file, bins = parse_cli()
 
-	clean_frame = pd.read_csv(clean_file, usecols=['roll_ellipse_area'])
+	clean_frame = read_clean(clean_file, columns=['roll_ellipse_area'])
 	plt.hist(
 		clean_frame['roll_ellipse_area'],
 		bins=bins,
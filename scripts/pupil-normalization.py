@@ -6,7 +6,7 @@ Inputs:
     4. Verbosity for debugging.
 
 What it does:
-    This function reads CSV file, 
+    This function reads clean file (CSV or .npy files), 
     Finds minimum and maximum value for the area of pupils
     Removes bottom (top if needed) outliers using IQR
     Interpolates the values
@@ -18,7 +18,7 @@ import os
 import logging
 from pathlib import Path
 from tqdm import tqdm
-from utility import is_valid_file
+from utility import is_valid_file, read_clean
 import matplotlib.pyplot as plt
 
 
@@ -28,7 +28,7 @@ def parse_cli():
 
     # All input that is needed
     parser = argparse.ArgumentParser(description="Sanitizer (drop low likelihood and high percentile, crop CSV, calculate locomotion)")
-    parser.add_argument("--file", dest="file", type=lambda x: is_valid_file(parser, x), required=True, help="CSV file to read.")
+    parser.add_argument("--file", dest="file", type=lambda x: is_valid_file(parser, x), required=True, help="Clean file to read (CSV or directory of .npy files).")
     parser.add_argument("-v", dest="verbose", default=False, help="increase output verbosity", action="store_true")
 
     args = parser.parse_args()
@@ -51,7 +51,7 @@ def main():
     # Parse the CSV file.
     file = parse_cli()
     
-    pupil_frame = pd.read_csv(file, header=0)
+    pupil_frame = read_clean(file, columns=["ellipse_area"])
 
     logging.info(f"Parsed CSV (n = {len(pupil_frame.index)})")
 
@@ -0,0 +1,289 @@
+# designed to be included in other programs
+
+import numpy as np
+
+EXACT_BACKEND = "exact"
+SKETCH_BACKEND = "sketch"
+
+# number of items a level of the sketch may hold before it is compacted
+SKETCH_SIZE = 2000
+# confidence of the reported error bound
+CONFIDENCE = 0.99
+# sketches created without a seed take the next child of this sequence, so that runs are reproducible,
+# but the compactions of sketches that are merged (e.g. of chunks of a stream) are independent
+_SKETCH_SEEDS = np.random.SeedSequence(0)
+# number of buckets a pass of ColumnQuantiles splits the range of the wanted rank in
+COLUMN_BUCKETS = 2**12
+
+
+class ExactQuantiles:
+	"""
+	Keeps every value seen and computes quantiles exactly (the same way as pandas Series.quantile).
+
+	Has the same interface as QuantileSketch, so the two can be used interchangeably.
+	"""
+
+	def __init__(self):
+		self.chunks = []
+
+	def update(self, values):
+		self.chunks += [np.asarray(values, dtype=np.float64).ravel()]
+
+	def merge(self, other):
+		self.chunks += other.chunks
+
+	def quantile(self, q, upper=None):
+		"""Return the q-quantile of the values not above upper (of all values if upper is None), ignoring NaNs"""
+		import pandas as pd
+
+		series = pd.Series(np.concatenate(self.chunks) if len(self.chunks) > 0 else [], dtype=np.float64)
+		if upper is not None:
+			series = series[~(series > upper)]
+		return series.quantile(q)
+
+	def error_bound(self):
+		"""Exact quantiles have no rank error"""
+		return 0.0
+
+
+class QuantileSketch:
+	"""
+	A mergeable streaming quantile sketch (hierarchy of compactors, as in KLL, with equal capacities).
+
+	Level h holds items of weight 2^h.
+	When a level holds more than `size` items, they are sorted and every other item (starting at a random offset) is promoted to the next level.
+	For any value, one compaction at level h changes its rank by 0 or by 2^h up or down with equal probability.
+	The sketch remembers the compactions, so the total rank error can be bounded with the given confidence (Hoeffding inequality).
+	Memory is O(size * log(n / size)).
+	The bound assumes the random offsets of all compactions are independent, so every sketch has its own seed (unless one is given).
+	"""
+
+	def __init__(self, size=SKETCH_SIZE, seed=None):
+		self.size = size
+		self.levels = [np.empty(0)]
+		self.count = 0
+		# sum of squared weights of all compactions so far, drives the error bound
+		self.compacted_weight = 0.0
+		self._random = np.random.default_rng(_SKETCH_SEEDS.spawn(1)[0] if seed is None else seed)
+
+	def update(self, values):
+		values = np.asarray(values, dtype=np.float64).ravel()
+		values = values[~np.isnan(values)]
+		self.count += len(values)
+		self.levels[0] = np.concatenate([self.levels[0], values])
+		self._compact()
+
+	def merge(self, other):
+		"""Add the content of other sketch (e.g. of a different shard) into this one"""
+		for h, items in enumerate(other.levels):
+			if h < len(self.levels):
+				self.levels[h] = np.concatenate([self.levels[h], items])
+			else:
+				self.levels += [items.copy()]
+		self.count += other.count
+		self.compacted_weight += other.compacted_weight
+		self._compact()
+
+	def _compact(self):
+		h = 0
+		while h < len(self.levels):
+			if len(self.levels[h]) > self.size:
+				items = np.sort(self.levels[h])
+				# an odd item stays on its level, only pairs are compacted
+				stay = len(items) % 2
+				offset = self._random.integers(2)
+				if h + 1 == len(self.levels):
+					self.levels += [np.empty(0)]
+				self.levels[h + 1] = np.concatenate([self.levels[h + 1], items[offset:len(items) - stay:2]])
+				self.levels[h] = items[len(items) - stay:]
+				self.compacted_weight += 4**h
+			h += 1
+
+	def _weighted_items(self):
+		"""Return all items sorted by value and their cumulative weights"""
+		items = np.concatenate(self.levels)
+		weights = np.concatenate([np.full(len(level), 2**h, dtype=np.float64) for h, level in enumerate(self.levels)])
+		order = np.argsort(items, kind="stable")
+		return items[order], np.cumsum(weights[order])
+
+	def rank(self, value):
+		"""Approximate number of values not above value"""
+		items, cumulative = self._weighted_items()
+		position = np.searchsorted(items, value, side="right")
+		return 0.0 if position == 0 else cumulative[position - 1]
+
+	def quantile(self, q, upper=None):
+		"""Return the approximate q-quantile of the values not above upper (of all values if upper is None)"""
+		items, cumulative = self._weighted_items()
+		if len(items) == 0:
+			return np.nan
+		total = cumulative[-1] if upper is None else self.rank(upper)
+		position = np.searchsorted(cumulative, q * total, side="left")
+		return items[min(position, len(items) - 1)]
+
+	def error_bound(self):
+		"""Return the bound of rank error as a fraction of the number of values, holds with probability CONFIDENCE"""
+		if self.count == 0:
+			return 0.0
+		return np.sqrt(2 * self.compacted_weight * np.log(2 / (1 - CONFIDENCE))) / self.count
+
+
+class ColumnQuantiles:
+	"""
+	Computes quantiles of a long column (e.g. memory mapped from disk) exactly, the same as ExactQuantiles, in passes over chunks of it.
+
+	The column is never read whole: every pass counts the values in buckets of the range that holds the wanted rank and narrows the range to one bucket,
+	until the values in the range fit in a chunk, which is then sorted. Memory is O(chunk_size), there are a few passes per quantile.
+	"""
+
+	# flips the magnitude bits of negative floats, so that their integer keys sort as the floats do
+	_NEGATIVE = np.int64(0x7FFFFFFFFFFFFFFF)
+
+	def __init__(self, values, chunk_size):
+		self.values = values
+		self.chunk_size = chunk_size
+
+	def _keys(self, upper):
+		"""Yield integer keys of the non-NaN values not above upper, chunk by chunk"""
+		for start in range(0, len(self.values), self.chunk_size):
+			values = np.asarray(self.values[start:start + self.chunk_size], dtype=np.float64)
+			values = values[~np.isnan(values)]
+			if upper is not None:
+				values = values[~(values > upper)]
+			keys = values.view(np.int64)
+			yield np.where(keys < 0, keys ^ self._NEGATIVE, keys)
+
+	def _select(self, k, upper):
+		"""Return the k-th smallest (from 0) of the values not above upper"""
+		# the range of keys (inclusive) that holds the wanted one, and the number of keys below the range
+		lower, higher = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+		below = 0
+		while lower < higher:
+			# python integers, the width of the range may not fit in int64
+			pivots = np.unique(np.array([lower + (higher - lower) * i // COLUMN_BUCKETS for i in range(1, COLUMN_BUCKETS)], dtype=np.int64))
+			counts = np.zeros(len(pivots) + 1, dtype=np.int64)
+			smallest, largest = higher, lower
+			collected, size = [], 0
+			for keys in self._keys(upper):
+				keys = keys[(keys >= lower) & (keys <= higher)]
+				if len(keys) == 0:
+					continue
+				counts += np.bincount(np.searchsorted(pivots, keys, side="right"), minlength=len(counts))
+				smallest, largest = min(smallest, int(keys.min())), max(largest, int(keys.max()))
+				if collected is not None:
+					collected += [keys]
+					size += len(keys)
+					if size > self.chunk_size:
+						collected = None
+
+			if collected is not None:
+				lower = int(np.sort(np.concatenate(collected))[k - below])
+				break
+
+			cumulative = np.cumsum(counts)
+			bucket = int(np.searchsorted(cumulative, k - below, side="right"))
+			if bucket > 0:
+				below += int(cumulative[bucket - 1])
+			lower = smallest if bucket == 0 else max(smallest, int(pivots[bucket - 1]))
+			higher = largest if bucket == len(pivots) else min(largest, int(pivots[bucket]) - 1)
+
+		key = np.int64(lower)
+		return float(np.array([key ^ self._NEGATIVE if key < 0 else key]).view(np.float64)[0])
+
+	def quantile(self, q, upper=None):
+		"""Return the q-quantile of the values not above upper (of all values if upper is None), ignoring NaNs"""
+		count = sum(len(keys) for keys in self._keys(upper))
+		if count == 0:
+			return np.nan
+
+		# the linear method of numpy percentile, as _sorted_quantile follows it
+		q = np.true_divide(q * 100.0, 100)
+		virtual = (count - 1) * q
+		previous = count - 1 if virtual >= count - 1 else int(np.floor(virtual))
+		gamma = virtual - previous
+
+		a = self._select(previous, upper)
+		b = a if previous == count - 1 else self._select(previous + 1, upper)
+		difference = b - a
+		return b - difference * (1 - gamma) if gamma >= 0.5 else a + difference * gamma
+
+	def error_bound(self):
+		"""Exact quantiles have no rank error"""
+		return 0.0
+
+
+def _sorted_quantile(rows, counts, q):
+	"""
+	Compute the q-quantile of every row of sorted rows, with counts of non-NaN values per row (NaNs are at the end).
+
+	Follows the linear method of numpy percentile step by step (including the way pandas quantile converts q to percents),
+	so the results are identical to Series.quantile of every row.
+	"""
+	q = np.true_divide(q * 100.0, 100)
+	virtual = (counts - 1) * q
+
+	above = virtual >= counts - 1
+	previous = np.where(above, counts - 1, np.floor(virtual)).astype(np.intp)
+	next = np.where(above, counts - 1, previous + 1)
+	gamma = virtual - previous
+
+	empty = counts == 0
+	previous[empty] = 0
+	next[empty] = 0
+
+	a = np.take_along_axis(rows, previous[:, None], axis=1)[:, 0]
+	b = np.take_along_axis(rows, next[:, None], axis=1)[:, 0]
+
+	# linear interpolation, numerically the same as numpy does it
+	difference = b - a
+	result = np.where(gamma >= 0.5, b - difference * (1 - gamma), a + difference * gamma)
+	result[empty] = np.nan
+
+	return result
+
+
+def block_quantiles(values, window, qs):
+	"""
+	Compute quantiles of consecutive non-overlapping blocks of window values, ignoring NaNs.
+
+	Full blocks are processed at once as rows of a (blocks, window) array, the last block may be shorter.
+	Returns an array of shape (len(qs), number of blocks).
+	"""
+	values = np.asarray(values, dtype=np.float64)
+	full = len(values) // window * window
+
+	blocks = [values[:full].reshape(-1, window)]
+	if full < len(values):
+		blocks += [values[full:].reshape(1, -1)]
+
+	result = []
+	for rows in blocks:
+		# NaNs are sorted to the end of each row
+		rows = np.sort(rows, axis=1)
+		counts = np.count_nonzero(~np.isnan(rows), axis=1)
+		result += [np.array([_sorted_quantile(rows, counts, q) for q in qs])]
+
+	return np.concatenate(result, axis=1)
+
+
+def rolling_quantiles(values, window, qs):
+	"""
+	Compute quantiles of a centered rolling window (the same alignment as pandas rolling with center=True), ignoring NaNs.
+
+	Windows near the ends of the series are shorter.
+	pandas keeps the window in an indexable skiplist, so every step is an O(log window) insertion and removal (in C, no Python loop per frame).
+	Quantiles are interpolated linearly, as block_quantiles does (up to floating point error).
+	Returns an array of shape (len(qs), len(values)).
+	"""
+	import pandas as pd
+
+	rolling = pd.Series(np.asarray(values, dtype=np.float64)).rolling(window, center=True, min_periods=1)
+
+	return np.array([rolling.quantile(float(q), interpolation="linear").to_numpy() for q in qs]).reshape(len(qs), len(values))
+
+
+def make_quantiles(backend):
+	"""Create an empty quantile accumulator for the backend name"""
+	if backend == SKETCH_BACKEND:
+		return QuantileSketch()
+	return ExactQuantiles()
@@ -10,24 +10,42 @@ Inputs:
 		7. Threshold that is considered an eyeblink. Anything BELOW this value will be dropped;
 		8. Number of points you want to plot (it is 0 by default). If you want to print everything, type -n 0;
 		9. Size of the sliding window;
-		10. Verbosity for debugging.
+		10. Verbosity for debugging;
+		11. Number of processes to fit ellipses with;
+		12. Chunk size to stream the CSV with (to bound memory for very long recordings);
+		13. Backend to compute radius ratio percentiles with (exact or approximate sketch);
+		14. Clamp mode of the sliding window (non-overlapping blocks or rolling window centered at every frame);
+		15. Directory to cache fitted ellipses in (or no cache at all);
+		16. Sweep config, YAML with lists of values of likelihood, percentiles, window, clamp mode and rolling, to write a clean CSV for every combination;
+		17. Format of the output, CSV or a directory with a binary .npy file per column (faster to read by the other scripts);
+		18. Live mode, to follow a CSV that DeepLabCut is still writing, with the interval to check for new rows and the time to wait for them.
 
 What it does:
 		This function reads CSV file, detects points with low likelihood, marks them as NaN (not a number) and gets them removed.
-		Next, it tries to fit an ellipse (ellipse.py).
+		Next, it tries to fit an ellipse (ellipse.py), or reads the ellipses fitted by a previous run from the cache.
 		If ellipse is found -- data is written into table, If ellipse not found data are are removed.
 		Ratios of radii that are not within threshold range get removed.
-		Sliding window removes last outliers.
+		Sliding window removes last outliers (clamps to percentiles of the window).
 		Rolling mean to smooth the plot and remove outliers.
-		Write CSV File
+		Write CSV File (or .npy files)
+		In live mode, all of the above runs on new rows as they are written, and peaks (peaks.py) are found and written as soon as they are final.
 """
 
 import os
 import logging
 from pathlib import Path
-from tqdm import tqdm
-from utility import is_valid_file
+from utility import CSV_FORMAT, NPY_FORMAT, is_valid_file, read_dlc_csv, clean_path, write_clean, evict_cache
+from quantiles import EXACT_BACKEND, SKETCH_BACKEND, CONFIDENCE
 
+# columns produced by the ellipse fitting stage
+ELLIPSE_COLUMNS = ["x0", "y0", "rlong", "rshort", "radius_ratio"]
+
+# parameters that can be swept over (--sweep)
+SWEEP_PARAMETERS = ["likelihood", "min_percentile", "max_percentile", "radius_min_percentile", "radius_max_percentile", "window", "clamp_mode", "rolling"]
+
+# clamp modes: percentiles of non-overlapping windows, or of a window centered at every frame
+BLOCK_CLAMP = "block"
+ROLLING_CLAMP = "rolling"
 
 
 # parse command-line options
@@ -43,6 +61,11 @@ def parse_cli():
 		else:
 			return a
 
+	def is_valid_workers(parser, arg):
+		if not arg.isnumeric() or int(arg) < 1:
+			parser.error(f"Invalid value {arg}, must be a positive number")
+		return int(arg)
+
 	# All input that is needed
 	parser = argparse.ArgumentParser(description="Sanitizer (drop low likelihood, compute ellipses, interpolate radius ratio outliers and center coordinates)")
 	parser.add_argument("--file", dest="file", type=lambda x: is_valid_file(parser, x), required=True, help="CSV file to read.")
@@ -54,111 +77,763 @@ def parse_cli():
 	parser.add_argument("--eyeblink", dest="eyeblink", type=int, default=50, help="Number of pixels between top and bottom lid. Datapoints below this value will be dropped.")
 	parser.add_argument("-n", dest="n", type=int, default=0, help="Number of points to plot. Not plotting in default")
 	parser.add_argument("--window", dest="window", type=int, default=500, help="Window size in frames")
+	parser.add_argument("--clamp-mode", dest="clamp_mode", choices=[BLOCK_CLAMP, ROLLING_CLAMP], default=BLOCK_CLAMP, help="Clamp X Y outliers to percentiles of non-overlapping windows (block) or of a window centered at every frame (rolling)")
 	parser.add_argument("--rolling", dest="rolling", type=int, default=10, help="Rolling mead value")
+	parser.add_argument("--workers", dest="workers", type=lambda x: is_valid_workers(parser, x), default=1, help="Number of processes to fit ellipses with. Single process in default")
+	parser.add_argument("--quantile-backend", dest="quantile_backend", choices=[EXACT_BACKEND, SKETCH_BACKEND], default=EXACT_BACKEND, help="How to compute radius ratio percentiles: exactly, or with a streaming sketch (approximate, single pass, mergeable)")
+	parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=0, help="Stream the CSV in chunks of this many frames to bound memory. Whole file in memory in default")
+	parser.add_argument("--sweep", dest="sweep", type=lambda x: is_valid_file(parser, x), default=None, help="YAML file with lists of parameter values; fit once and write a clean CSV for every combination plus a summary")
+	parser.add_argument("--cache-dir", dest="cache_dir", type=str, default=str(Path(__file__).parent / ".." / "cache"), help="Directory to cache fitted ellipses in, re-runs with the same file and likelihood skip the fitting. The most recently used entries are kept up to 1 GB")
+	parser.add_argument("--format", dest="format", choices=[CSV_FORMAT, NPY_FORMAT], default=CSV_FORMAT, help="Write the clean data as CSV, or as a directory with a .npy file per column that the other scripts read (and memory map) much faster")
+	parser.add_argument("--live", dest="live", default=False, help="Follow the CSV while DeepLabCut writes it, sanitize new rows and find peaks as they come (block clamp mode, sketch quantiles, CSV output)", action="store_true")
+	parser.add_argument("--poll-interval", dest="poll_interval", type=float, default=1.0, help="In live mode, seconds between checks for new rows")
+	parser.add_argument("--live-timeout", dest="live_timeout", type=float, default=60.0, help="In live mode, seconds without new rows after which the recording is over")
+	parser.add_argument("--no-cache", dest="no_cache", default=False, help="Do not read or write the cache of fitted ellipses", action="store_true")
 	parser.add_argument("-v", dest="verbose", default=False, help="increase output verbosity", action="store_true")
 
 	args = parser.parse_args()
 
+	if args.sweep is not None and args.chunk_size > 0:
+		parser.error("--sweep works in memory, it cannot be combined with --chunk-size")
+	if args.live and (args.sweep is not None or args.chunk_size > 0):
+		parser.error("--live cannot be combined with --sweep or --chunk-size")
+	if args.live and (args.clamp_mode != BLOCK_CLAMP or args.format != CSV_FORMAT):
+		parser.error("--live clamps blocks and appends to a CSV, it cannot be combined with --clamp-mode rolling or --format npy")
+
 	logging.basicConfig(
 		level=logging.DEBUG if args.verbose else logging.INFO,
 		format='%(asctime)s %(levelname)-8s %(message)s',
 		datefmt='%a, %d %b %Y %H:%M:%S',
 	)
 
-	return args.file, args.likelihood, args.min_percentile, args.max_percentile, args.radius_max_percentile, args.radius_min_percentile, args.eyeblink, args.n, args.window, args.rolling
+	return args.file, args.likelihood, args.min_percentile, args.max_percentile, args.radius_max_percentile, args.radius_min_percentile, args.eyeblink, args.n, args.window, args.clamp_mode, args.rolling, args.workers, args.chunk_size, args.quantile_backend, None if args.no_cache else args.cache_dir, args.sweep, args.format, args.live, args.poll_interval, args.live_timeout
 
 
-def main():
+def fit_ellipses(xs, ys):
+	"""
+	Fit an ellipse for every row of coordinates (ellipse.py).
+
+	Returns an (N, 5) array with ELLIPSE_COLUMNS, rows where ellipse is not found are NaN.
+	"""
+	import numpy as np
+	from ellipse import ellipse_fit_many
+
+	_, ellipses = ellipse_fit_many(xs, ys)
+
+	return np.column_stack([
+		ellipses["X0_in"],
+		ellipses["Y0_in"],
+		ellipses["b"],
+		ellipses["a"],
+		ellipses["a"] / ellipses["b"],
+	])
+
+
+def _fit_shard(names, shape, start, end):
+	"""A worker for EllipseFitter, fits rows [start, end) of the shared coordinates into the shared results"""
+	import numpy as np
+	from multiprocessing import shared_memory
+
+	blocks = [shared_memory.SharedMemory(name=name) for name in names]
+	xs = np.ndarray(shape, dtype=np.float64, buffer=blocks[0].buf)
+	ys = np.ndarray(shape, dtype=np.float64, buffer=blocks[1].buf)
+	results = np.ndarray((shape[0], len(ELLIPSE_COLUMNS)), dtype=np.float64, buffer=blocks[2].buf)
+
+	results[start:end] = fit_ellipses(xs[start:end], ys[start:end])
+
+	# views into shared memory must be released before it can be closed
+	del xs, ys, results
+	for block in blocks:
+		block.close()
+
+
+class EllipseFitter:
+	"""
+	Fits ellipses the same way as fit_ellipses, but splits the rows in contiguous shards and fits them in a pool of processes.
+
+	Coordinates and results live in shared memory, workers only receive the shard boundaries.
+	The pool and the shared memory are kept between calls (streaming fits chunk after chunk), and released on close.
+	"""
+
+	def __init__(self, workers):
+		self.workers = workers
+		self.executor = None
+		self.blocks = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		self.close()
+
+	def _release_blocks(self):
+		for block in self.blocks:
+			block.close()
+			block.unlink()
+		self.blocks = []
+
+	def fit(self, xs, ys):
+		"""Every row is fitted independently of the others, so the result is identical to the one of fit_ellipses"""
+		import numpy as np
+		from itertools import repeat
+		from multiprocessing import shared_memory
+		from concurrent.futures import ProcessPoolExecutor
+
+		if self.workers <= 1 or len(xs) == 0:
+			return fit_ellipses(xs, ys)
+
+		shape = xs.shape
+		results_shape = (shape[0], len(ELLIPSE_COLUMNS))
+		sizes = [int(np.prod(size)) * 8 for size in [shape, shape, results_shape]]
+		# blocks are grown only when the rows do not fit, chunks of a stream have the same size but the last one
+		if len(self.blocks) == 0 or any(block.size < size for block, size in zip(self.blocks, sizes)):
+			self._release_blocks()
+			self.blocks = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+		if self.executor is None:
+			self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+		np.ndarray(shape, dtype=np.float64, buffer=self.blocks[0].buf)[:] = xs
+		np.ndarray(shape, dtype=np.float64, buffer=self.blocks[1].buf)[:] = ys
+
+		bounds = np.linspace(0, shape[0], self.workers + 1, dtype=int)
+		# consume the iterator to propagate exceptions from the workers
+		list(self.executor.map(_fit_shard, repeat([block.name for block in self.blocks]), repeat(shape), bounds[:-1], bounds[1:]))
+
+		return np.ndarray(results_shape, dtype=np.float64, buffer=self.blocks[2].buf).copy()
+
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+		self._release_blocks()
+
+
+def fit_ellipses_parallel(xs, ys, workers):
+	"""Same as fit_ellipses, but in a pool of processes (EllipseFitter) started for this call"""
+	with EllipseFitter(workers) as fitter:
+		return fitter.fit(xs, ys)
+
+
+def read_ellipses(data, likelihood, workers, fitter=None):
+	"""
+	Take parsed DeepLabCut data (utility.read_dlc_csv, all body parts are points of the pupil) and fit an ellipse for every row.
+
+	Rows with low likelihood and rows where ellipse is not found are NaN.
+	Ellipses are fitted with the given EllipseFitter, or in a pool of workers started for this call if it is None.
+	Returns a frame with ELLIPSE_COLUMNS, and a boolean mask of rows with low likelihood.
+	"""
 	import pandas as pd
 	import numpy as np
-	from ellipse import ellipse_fit
-
-	file, likelihood, min_percentile, max_percentile, radius_max_percentile, radius_min_percentile, eyeblink, n, window, rolling = parse_cli()
-
-	input = pd.read_csv(file, header=2, nrows=None if n == 0 else n)
-
-	logging.info(f"Parsed CSV (n = {len(input.index)})")
-
-	likelihood_columns = [3, 6, 9, 12, 15, 18, 21, 24]
-
-	initial_data = []
-
-	with tqdm(total=len(input.index)) as pbar:
-		for index, row in input.iterrows():
-
-			low_likelihood = False
-			for column in likelihood_columns:
-				if row[column] < likelihood:
-					low_likelihood = True  # find low likelihood
-					break
-			if low_likelihood:
-				initial_data += [[np.nan, np.nan, np.nan, np.nan, np.nan]]  # if not within normal range --- remove
-			else:
-				status, ellipse = ellipse_fit(
-					np.array([row["x"], row["x.1"], row["x.2"], row["x.3"], row["x.4"], row["x.5"], row["x.6"], row["x.7"]]),  #ellipse.py fit the ellipse
-					np.array([row["y"], row["y.1"], row["y.2"], row["y.3"], row["y.4"], row["y.5"], row["y.6"], row["y.7"]]),
-				)
-				if status:
-					initial_data += [[
-						ellipse["X0_in"],
-						ellipse["Y0_in"],
-						ellipse["b"],
-						ellipse["a"],
-						ellipse["a"] / ellipse["b"],  #ellipse is found
-					]]
-				else:
-					initial_data += [[np.nan, np.nan, np.nan, np.nan, np.nan]]  #ellipse is not found,
 
-			pbar.update(1)
+	# find low likelihood, if any point is not within normal range --- remove the whole row
+	low_likelihood = (data["likelihood"] < likelihood).any(axis=1)
 
-	frame = pd.DataFrame(initial_data, columns=['x0', 'y0', 'rlong', 'rshort', 'radius_ratio'])
+	# fit ellipses for all remaining rows at once, in shards if there are several workers
+	xs = np.ascontiguousarray(data["x"][~low_likelihood], dtype=np.float64)
+	ys = np.ascontiguousarray(data["y"][~low_likelihood], dtype=np.float64)
 
-	logging.info("Converted to ellipses")
+	frame = pd.DataFrame(np.nan, index=range(len(low_likelihood)), columns=ELLIPSE_COLUMNS)
+	frame.loc[~low_likelihood, ELLIPSE_COLUMNS] = fit_ellipses_parallel(xs, ys, workers) if fitter is None else fitter.fit(xs, ys)
 
-	# Removes outliers with unacceptable ratio of radii
-	frame[frame.radius_ratio > frame.radius_ratio.quantile(radius_max_percentile / 100.0)] = np.nan
-	frame[frame.radius_ratio < frame.radius_ratio.quantile(radius_min_percentile / 100.0)] = np.nan
+	return frame, low_likelihood
 
-	logging.info("Removed Radius Ratio Outliers")
 
-	# Sliding Window. Removes outliers
-	current = 0  # first position
-	while current < len(frame.index):
-		current_window = min(window, len(frame.index) - current)
-		current_frame = frame[current:current + current_window].copy()
+def ellipses_cache_paths(cache_dir, file, likelihood, nrows):
+	"""
+	Return paths to the cached ellipses and low likelihood mask of the input file.
 
-		x0_max_percentile = current_frame.x0.quantile(max_percentile / 100.0)
-		x0_min_percentile = current_frame.x0.quantile(min_percentile / 100.0)
-		y0_max_percentile = current_frame.y0.quantile(max_percentile / 100.0)
-		y0_min_percentile = current_frame.y0.quantile(min_percentile / 100.0)
+	The key is the hash of the file content together with the parameters that change the fit (likelihood threshold and number of rows read).
+	"""
+	import hashlib
 
-		current_frame.loc[current_frame.x0 > x0_max_percentile, "x0"] = x0_max_percentile
-		current_frame.loc[current_frame.x0 < x0_min_percentile, "x0"] = x0_min_percentile
+	digest = hashlib.sha256()
+	with open(file, "rb") as input:
+		for block in iter(lambda: input.read(1 << 20), b""):
+			digest.update(block)
+	# coordinates are parsed as float32 and likelihoods as float64 (utility.read_dlc_csv), other fits must not be reused
+	digest.update(f"likelihood={likelihood};nrows={nrows};coordinates=float32;likelihoods=float64".encode())
 
-		current_frame.loc[current_frame.y0 > y0_max_percentile, "y0"] = y0_max_percentile
-		current_frame.loc[current_frame.y0 < y0_min_percentile, "y0"] = y0_min_percentile
+	key = f"{Path(file).stem}-{digest.hexdigest()[:16]}"
+	return Path(cache_dir) / f"{key}-ellipses.npy", Path(cache_dir) / f"{key}-likelihood.npy"
 
-		frame[current:current + current_window] = current_frame.copy()
-		current += window
 
-	frame.interpolate(inplace=True)  # interpolation
+def is_ellipses_cached(cache_paths):
+	"""Return whether the ellipses and the low likelihood mask are cached, marking them as recently used"""
+	try:
+		# the modification time orders the entries for eviction
+		for path in cache_paths:
+			os.utime(path)
+	except OSError:
+		# missing, or removed by another process meanwhile
+		return False
 
-	logging.info("Removed X Y Outliers")
+	return True
+
+
+def write_ellipses_cache(cache_paths, ellipses, low_likelihood):
+	"""Write the (N, 5) array of ellipses and the low likelihood mask to the cache, replacing files atomically, and remove the least recently used entries of the cache above its size"""
+	import numpy as np
+
+	for path, array in zip(cache_paths, [ellipses, low_likelihood]):
+		path.parent.mkdir(parents=True, exist_ok=True)
+		temporary_path = path.with_suffix(".tmp")
+		with open(temporary_path, "wb") as cache_file:
+			np.save(cache_file, array)
+		os.replace(temporary_path, path)
+
+	evict_cache(cache_paths[0].parent, cache_paths)
+
+	logging.info(f"Cached ellipses: {cache_paths[0]}")
+
+
+def radius_ratio_thresholds(quantiles, radius_min_percentile, radius_max_percentile):
+	"""
+	Compute min and max acceptable ratio of radii from the given percentiles (quantiles.py).
+
+	Max threshold is computed first, and min threshold is computed for the values not above max.
+	"""
+	ratio_max = quantiles.quantile(radius_max_percentile / 100.0)
+	ratio_min = quantiles.quantile(radius_min_percentile / 100.0, upper=ratio_max)
+
+	logging.info(f"Radius ratio thresholds: [{ratio_min}, {ratio_max}] (rank error at most {quantiles.error_bound():.4%} with {CONFIDENCE:.0%} confidence)")
+
+	return ratio_min, ratio_max
+
+
+def remove_radius_ratio_outliers(frame, ratio_min, ratio_max):
+	"""Removes (sets to NaN) whole rows with unacceptable ratio of radii"""
+	import numpy as np
+
+	frame[frame.radius_ratio > ratio_max] = np.nan
+	frame[frame.radius_ratio < ratio_min] = np.nan
+
+
+def clamp_windows(frame, window, min_percentile, max_percentile, clamp_mode=BLOCK_CLAMP):
+	"""
+	Sliding Window. Removes outliers.
+
+	In block mode, for every window of frames, clamps x0 and y0 to this window's min and max percentiles.
+	Percentiles of all windows are computed at once (quantiles.py), the last window may be shorter.
+
+	In rolling mode, clamps every frame to the percentiles of the window centered at this frame.
+	"""
+	import numpy as np
+	from quantiles import block_quantiles, rolling_quantiles
+
+	for column in ["x0", "y0"]:
+		values = frame[column].to_numpy(dtype=np.float64)
+
+		if clamp_mode == ROLLING_CLAMP:
+			lower, upper = rolling_quantiles(values, window, [min_percentile / 100.0, max_percentile / 100.0])
+		else:
+			lower, upper = block_quantiles(values, window, [min_percentile / 100.0, max_percentile / 100.0])
+			lower = np.repeat(lower, window)[:len(values)]
+			upper = np.repeat(upper, window)[:len(values)]
+
+		values = np.where(values > upper, upper, values)
+		values = np.where(values < lower, lower, values)
+
+		frame[column] = values
+
+
+def add_smoothed_columns(frame, rolling):
+	"""Adds rolling means of the center coordinates, and the pupil area with its rolling mean"""
+	import numpy as np
 
 	frame["roll_x0"] = frame["x0"].rolling(rolling).mean()  # rolling mean to smooth the plot
 	frame["roll_y0"] = frame["y0"].rolling(rolling).mean()  # rolling mean to smooth the plot
 
-	logging.info("Smoothed the plot")
-
 	frame["ellipse_area"] = (frame["rlong"] * frame["rshort"]) * np.pi
 	frame["roll_ellipse_area"] = frame["ellipse_area"].rolling(rolling).mean()  # rolling mean to smooth the plot
 
+
+def interpolate_chunk(values, start, before, after):
+	"""
+	Linearly interpolate NaNs of a chunk (1-D array, in place) of a longer series, the same way as pandas interpolate does for the whole series.
+
+	The chunk starts at index start of the series.
+	before and after are the (index, value) of the closest valid points outside of the chunk, or None if there are none.
+	Leading NaNs of the series stay NaN, trailing NaNs take the last valid value.
+	"""
+	import numpy as np
+
+	nans = np.isnan(values)
+	if not nans.any():
+		return
+
+	indices = np.arange(start, start + len(values))
+	valid_indices = indices[~nans]
+	valid_values = values[~nans]
+	if before is not None:
+		valid_indices = np.concatenate([[before[0]], valid_indices])
+		valid_values = np.concatenate([[before[1]], valid_values])
+	if after is not None:
+		valid_indices = np.concatenate([valid_indices, [after[0]]])
+		valid_values = np.concatenate([valid_values, [after[1]]])
+
+	if len(valid_indices) == 0:
+		return
+
+	# do not extrapolate backwards
+	fill = nans & (indices > valid_indices[0])
+	values[fill] = np.interp(indices[fill], valid_indices, valid_values)
+
+
+def sanitize_streaming(file, nrows, chunk_size, likelihood, min_percentile, max_percentile, radius_max_percentile, radius_min_percentile, window, clamp_mode, rolling, workers, quantile_backend, cache_paths, output_path, format=CSV_FORMAT):
+	"""
+	Same as the default in-memory mode, but with memory bounded by the chunk size rather than by the length of the recording.
+
+	The first pass reads the CSV in chunks, fits ellipses and spills the results to a temporary on-disk array (or reads them from the cache).
+	Ellipses are fitted in one pool of workers for all chunks.
+	With the sketch backend, it also collects the radius ratios of every chunk and merges them into one bounded-memory sketch.
+	The second pass computes the radius ratio percentiles over the whole recording (exact ones in passes over the spill file, quantiles.ColumnQuantiles),
+	then removes outliers chunk by chunk (chunks are aligned to windows).
+	The third pass interpolates, smooths and appends chunks to the output (utility.write_clean).
+	Interpolation and rolling means look at the neighbouring chunks, so the output matches the in-memory mode up to floating point error of the rolling means.
+	"""
+	import pandas as pd
+	import numpy as np
+	import tempfile
+	from quantiles import ColumnQuantiles, make_quantiles
+
+	# exact percentiles are read from the spill file afterwards, keeping every ratio in memory would defeat streaming
+	quantiles = None if quantile_backend == EXACT_BACKEND else make_quantiles(quantile_backend)
+
+	cached = cache_paths is not None and is_ellipses_cached(cache_paths)
+
+	def fitted_chunks():
+		"""Yield chunks of ellipses (as (n, 5) arrays) and their low likelihood masks, from the cache or fitted from the CSV"""
+		if cached:
+			ellipses = np.load(cache_paths[0], mmap_mode="r")
+			low_likelihood = np.load(cache_paths[1], mmap_mode="r")
+			for start in range(0, len(ellipses), chunk_size):
+				yield np.array(ellipses[start:start + chunk_size]), np.array(low_likelihood[start:start + chunk_size])
+		else:
+			with EllipseFitter(workers) as fitter:
+				for dlc in read_dlc_csv(file, nrows=nrows, chunksize=chunk_size):
+					ellipses, low_likelihood = read_ellipses(dlc, likelihood, workers, fitter)
+					yield ellipses.to_numpy(dtype=np.float64), low_likelihood
+
+	with tempfile.TemporaryDirectory() as directory:
+		spill_path = Path(directory) / "ellipses.bin"
+		likelihood_spill_path = Path(directory) / "likelihood.bin"
+
+		# first pass: parse and fit, append raw rows to the spill file
+		length = 0
+		with open(spill_path, "wb") as spill, open(likelihood_spill_path, "wb") as likelihood_spill:
+			for ellipses, low_likelihood in fitted_chunks():
+				spill.write(ellipses.tobytes())
+				likelihood_spill.write(low_likelihood.astype(bool).tobytes())
+				length += len(ellipses)
+
+				if quantiles is not None:
+					chunk_quantiles = make_quantiles(quantile_backend)
+					chunk_quantiles.update(ellipses[:, ELLIPSE_COLUMNS.index("radius_ratio")])
+					quantiles.merge(chunk_quantiles)
+
+		if cached:
+			logging.info(f"Read ellipses from cache: {cache_paths[0]} (n = {length})")
+		else:
+			logging.info(f"Parsed CSV and converted to ellipses (n = {length})")
+
+		if length == 0:
+			write_clean(pd.DataFrame(columns=ELLIPSE_COLUMNS + ["roll_x0", "roll_y0", "ellipse_area", "roll_ellipse_area"]), output_path, format)
+			return
+
+		data = np.memmap(spill_path, dtype=np.float64, mode="r+", shape=(length, len(ELLIPSE_COLUMNS)))
+
+		# cache the ellipses before the spill file is modified in place
+		if cache_paths is not None and not cached:
+			write_ellipses_cache(cache_paths, data, np.memmap(likelihood_spill_path, dtype=bool, mode="r", shape=(length, )))
+
+		columns = {column: data[:, i] for i, column in enumerate(ELLIPSE_COLUMNS)}
+
+		# second pass: percentiles of the radius ratio over the whole recording, then remove outliers
+		if quantiles is None:
+			quantiles = ColumnQuantiles(columns["radius_ratio"], chunk_size)
+		ratio_min, ratio_max = radius_ratio_thresholds(quantiles, radius_min_percentile, radius_max_percentile)
+
+		# block clamping windows must not cross chunk boundaries
+		chunk_size = max(1, chunk_size // window) * window
+		# rolling clamping windows need half a window of neighbours on both sides of the chunk
+		margin = window // 2 if clamp_mode == ROLLING_CLAMP else 0
+
+		# results of a chunk are written only after the next chunk has read its (unclamped) margin
+		pending = None
+		for start in range(0, length, chunk_size):
+			end = min(length, start + chunk_size)
+			left = max(0, start - margin)
+			right = min(length, end + margin)
+
+			frame = pd.DataFrame(data[left:right], columns=ELLIPSE_COLUMNS)
+			remove_radius_ratio_outliers(frame, ratio_min, ratio_max)
+			clamp_windows(frame, window, min_percentile, max_percentile, clamp_mode)
+
+			if pending is not None:
+				data[pending[0]:pending[1]] = pending[2]
+			pending = (start, end, frame.to_numpy()[start - left:end - left])
+
+		data[pending[0]:pending[1]] = pending[2]
+
+		data.flush()
+
+		logging.info("Removed Radius Ratio Outliers")
+		logging.info("Removed X Y Outliers")
+
+		def closest_valid(column, start, step):
+			"""Find the closest non-NaN (index, value) of the column from start (inclusive) going in the direction of step"""
+			while 0 <= start < length:
+				if step > 0:
+					values = column[start:start + chunk_size]
+				else:
+					values = column[max(0, start - chunk_size + 1):start + 1][::-1]
+				valid = np.flatnonzero(~np.isnan(values))
+				if len(valid) > 0:
+					return start + step * valid[0], values[valid[0]]
+				start += step * len(values)
+			return None
+
+		# third pass: interpolate and smooth chunk by chunk, carrying the tail of the previous chunk for rolling means
+		tail = None
+		for start in range(0, length, chunk_size):
+			end = min(length, start + chunk_size)
+			chunk = np.array(data[start:end])
+			for i, column in enumerate(ELLIPSE_COLUMNS):
+				interpolate_chunk(chunk[:, i], start, closest_valid(columns[column], start - 1, -1), closest_valid(columns[column], end, 1))
+
+			frame = pd.DataFrame(chunk, index=range(start, end), columns=ELLIPSE_COLUMNS)
+			if tail is not None:
+				frame = pd.concat([tail, frame])
+			add_smoothed_columns(frame, rolling)
+			write_clean(frame.loc[start:], output_path, format, start, length)
+
+			tail = frame.loc[max(frame.index[0], end - rolling + 1):, ELLIPSE_COLUMNS]
+
+		del data
+
+	logging.info("Smoothed the plot")
+	logging.info("Pupil area calculated and smoothed")
+
+
+def sanitize_live(file, likelihood, min_percentile, max_percentile, radius_max_percentile, radius_min_percentile, window, rolling, output_path, peaks_path, poll_interval, timeout):
+	"""
+	Follow a DeepLabCut CSV that is still being written, sanitize the new rows as they come and find peaks on the fly.
+
+	Every stage runs on the new rows only, and keeps a bounded state between them:
+	ellipses are fitted for the new rows, and radius ratio outliers are removed with the thresholds of a sketch of all ratios so far
+	(so a row is compared to the ratios up to its time rather than of the whole recording);
+	X Y outliers are clamped once a block of the window is complete (block clamp mode);
+	gaps are interpolated once the next valid row comes; rolling means carry the tail of the previous rows.
+	Clean rows are appended to the output CSV, and peaks (peaks.LivePeaks) are written to the peaks file as soon as they are final.
+	Memory does not grow with the length of the recording, only the rows of a gap are held until it ends.
+	Stops once no rows were appended for timeout seconds (or on Ctrl+C), and sanitizes the rest as the end of the recording.
+	"""
+	import pandas as pd
+	import numpy as np
+	from quantiles import make_quantiles
+	from peaks import LivePeaks
+	from utility import HORIZONTAL_TAG, VERTICAL_TAG, HIGH_TYPE, LOW_TYPE, _tag, tail_dlc_csv, PeakStore, update_peaks_file
+
+	quantiles = make_quantiles(SKETCH_BACKEND)
+	live_peaks = LivePeaks([HORIZONTAL_TAG, VERTICAL_TAG])
+	peaks = PeakStore()
+	update_peaks_file(peaks, peaks_path)
+
+	# rows of the block that is not complete yet, and rows after the last valid row
+	unclamped = pd.DataFrame(columns=ELLIPSE_COLUMNS, dtype=np.float64)
+	held = pd.DataFrame(columns=ELLIPSE_COLUMNS, dtype=np.float64)
+	# the last valid (index, value) of every column, and the last rows for rolling means
+	before = {column: None for column in ELLIPSE_COLUMNS}
+	tail = None
+
+	def write(clamped, final):
+		"""Interpolate, smooth and write the clamped rows that are ready, and record the peaks that became final"""
+		nonlocal held, tail
+
+		frame = pd.concat([held, clamped]) if len(held.index) > 0 else clamped
+		if not final:
+			valid = np.flatnonzero(frame.notna().all(axis=1).to_numpy())
+			ready = 0 if len(valid) == 0 else valid[-1] + 1
+			frame, held = frame.iloc[:ready], frame.iloc[ready:]
+
+		found = []
+		if len(frame.index) > 0:
+			start = frame.index[0]
+			chunk = frame.to_numpy(dtype=np.float64, copy=True)
+			for i, column in enumerate(ELLIPSE_COLUMNS):
+				interpolate_chunk(chunk[:, i], start, before[column], None)
+				valid = np.flatnonzero(~np.isnan(chunk[:, i]))
+				if len(valid) > 0:
+					before[column] = (start + valid[-1], chunk[valid[-1], i])
+
+			frame = pd.DataFrame(chunk, index=frame.index, columns=ELLIPSE_COLUMNS)
+			if tail is not None:
+				frame = pd.concat([tail, frame])
+			add_smoothed_columns(frame, rolling)
+			write_clean(frame.loc[start:], output_path, CSV_FORMAT, start)
+			tail = frame[ELLIPSE_COLUMNS].iloc[max(0, len(frame.index) - rolling + 1):]
+
+			found += [live_peaks.update({tag: frame.loc[start:, tag].to_numpy() for tag in [HORIZONTAL_TAG, VERTICAL_TAG]})]
+		if final:
+			found += [live_peaks.flush()]
+
+		added = 0
+		for peaks_by_tag in found:
+			for tag, (highs, lows) in peaks_by_tag.items():
+				for type, values in [(HIGH_TYPE, highs), (LOW_TYPE, lows)]:
+					for peak in values:
+						logging.info(f"Peak {_tag(tag, type)} at frame {peak}")
+						peaks.add(tag, type, peak)
+						added += 1
+		if added > 0:
+			update_peaks_file(peaks, peaks_path)
+
+	rows = 0
+	try:
+		for dlc in tail_dlc_csv(file, poll_interval=poll_interval, timeout=timeout):
+			ellipses, _ = read_ellipses(dlc, likelihood, 1)
+			ellipses.index += rows
+			rows += len(ellipses.index)
+
+			quantiles.update(ellipses.radius_ratio.to_numpy())
+			ratio_max = quantiles.quantile(radius_max_percentile / 100.0)
+			ratio_min = quantiles.quantile(radius_min_percentile / 100.0, upper=ratio_max)
+			remove_radius_ratio_outliers(ellipses, ratio_min, ratio_max)
+
+			unclamped = pd.concat([unclamped, ellipses]) if len(unclamped.index) > 0 else ellipses
+			complete = len(unclamped.index) // window * window
+			if complete > 0:
+				clamped, unclamped = unclamped.iloc[:complete].copy(), unclamped.iloc[complete:]
+				clamp_windows(clamped, window, min_percentile, max_percentile, BLOCK_CLAMP)
+				write(clamped, False)
+
+			logging.debug(f"Sanitized {rows} rows, radius ratio thresholds: [{ratio_min}, {ratio_max}]")
+	except KeyboardInterrupt:
+		logging.info("Stopped following the file")
+
+	# the last block may be shorter, and trailing gaps take the last valid value, as at the end of any recording
+	clamped = unclamped.copy()
+	if len(clamped.index) > 0:
+		clamp_windows(clamped, window, min_percentile, max_percentile, BLOCK_CLAMP)
+	write(clamped, True)
+
+	logging.info(f"Sanitized {rows} rows, found {len(peaks)} peaks: {peaks_path}")
+
+
+def sanitize(frame, min_percentile, max_percentile, radius_max_percentile, radius_min_percentile, window, clamp_mode, rolling, quantile_backend):
+	"""
+	Run the stages after ellipse fitting on the frame of ellipses (modified in place).
+
+	Removes radius ratio outliers, clamps X Y outliers, interpolates and smooths.
+	Returns a dictionary with the number of rows affected by every stage.
+	"""
+	import numpy as np
+	from quantiles import make_quantiles
+
+	stats = {}
+
+	quantiles = make_quantiles(quantile_backend)
+	quantiles.update(frame.radius_ratio.to_numpy())
+
+	missing = np.count_nonzero(frame.radius_ratio.isna())
+	remove_radius_ratio_outliers(frame, *radius_ratio_thresholds(quantiles, radius_min_percentile, radius_max_percentile))
+	stats["radius_ratio_dropped"] = np.count_nonzero(frame.radius_ratio.isna()) - missing
+
+	logging.info("Removed Radius Ratio Outliers")
+
+	for column in ["x0", "y0"]:
+		stats[f"{column}_clamped"] = frame[column].to_numpy()
+	clamp_windows(frame, window, min_percentile, max_percentile, clamp_mode)
+	for column in ["x0", "y0"]:
+		stats[f"{column}_clamped"] = np.count_nonzero(stats[f"{column}_clamped"] != frame[column].to_numpy()) - np.count_nonzero(frame[column].isna())
+
+	missing = np.count_nonzero(frame.x0.isna())
+	frame.interpolate(inplace=True)  # interpolation
+	stats["interpolated"] = missing - np.count_nonzero(frame.x0.isna())
+
+	logging.info("Removed X Y Outliers")
+
+	add_smoothed_columns(frame, rolling)
+
+	logging.info("Smoothed the plot")
 	logging.info("Pupil area calculated and smoothed")
 
-	output_path = Path(__file__).parent / ".." / "clean" / f"{Path(file).stem}_clean.csv"
-	frame.to_csv(output_path)
+	return stats
+
+
+def read_sweep(sweep_file, defaults):
+	"""
+	Read the sweep config (YAML) and return the list of all parameter combinations.
+
+	The config maps parameter names (SWEEP_PARAMETERS) to a value or a list of values.
+	Parameters missing from the config take the value given in the command line (defaults).
+	"""
+	import itertools
+	import yaml
+
+	with open(sweep_file, "r") as config_file:
+		config = yaml.safe_load(config_file) or {}
+
+	unknown = set(config.keys()).difference(SWEEP_PARAMETERS)
+	if len(unknown) > 0:
+		logging.critical(f"Unknown sweep parameters: {sorted(unknown)}, expected some of {SWEEP_PARAMETERS}")
+		exit(1)
+
+	values = []
+	for parameter in SWEEP_PARAMETERS:
+		value = config.get(parameter, defaults[parameter])
+		values += [value if isinstance(value, list) else [value]]
+
+	return [dict(zip(SWEEP_PARAMETERS, combination)) for combination in itertools.product(*values)]
+
+
+# fitted ellipses and minimal likelihood of every row, shared by the sweep workers
+_sweep_data = {}
+
+
+def _init_sweep(ellipses, min_likelihood):
+	"""Initializer of sweep workers, receives the data once per worker process"""
+	_sweep_data["ellipses"] = ellipses
+	_sweep_data["min_likelihood"] = min_likelihood
+
+
+def _sweep_combination(combination, quantile_backend, output_path, format):
+	"""Sanitize fitted ellipses with one combination of parameters, write the clean file and return the stats"""
+	import pandas as pd
+	import numpy as np
+
+	frame = pd.DataFrame(_sweep_data["ellipses"].copy(), columns=ELLIPSE_COLUMNS)
+
+	# if any point is not within normal range --- remove the whole row
+	low_likelihood = _sweep_data["min_likelihood"] < combination["likelihood"]
+	frame.loc[low_likelihood, :] = np.nan
+
+	stats = {
+		"low_likelihood_dropped": np.count_nonzero(low_likelihood),
+		"ellipse_not_found": np.count_nonzero(frame.x0.isna()) - np.count_nonzero(low_likelihood),
+	}
+	stats.update(sanitize(
+		frame,
+		combination["min_percentile"],
+		combination["max_percentile"],
+		combination["radius_max_percentile"],
+		combination["radius_min_percentile"],
+		combination["window"],
+		combination["clamp_mode"],
+		combination["rolling"],
+		quantile_backend,
+	))
+
+	write_clean(frame, output_path, format)
+
+	return stats
+
+
+def sanitize_sweep(data, combinations, workers, quantile_backend, output_directory, stem, format=CSV_FORMAT):
+	"""
+	Fit ellipses once and sanitize them with every combination of parameters, in a pool of processes if there are several workers.
+
+	Ellipses are fitted for all rows, the likelihood of each combination is applied afterwards (fit of a row does not depend on other rows).
+	Writes a clean file per combination and a summary CSV with the parameters and the number of rows affected by every stage.
+	"""
+	import pandas as pd
+	import numpy as np
+	from itertools import repeat
+	from concurrent.futures import ProcessPoolExecutor
+
+	# likelihood below any threshold does not exclude rows, so all of them are fitted
+	frame, _ = read_ellipses(data, -np.inf, workers)
+	ellipses = frame.to_numpy(dtype=np.float64)
+	# a row has low likelihood if its least likely point is below the threshold
+	min_likelihood = np.fmin.reduce(data["likelihood"], axis=1)
+
+	logging.info(f"Converted to ellipses, sweeping over {len(combinations)} combinations")
+
+	output_directory.mkdir(parents=True, exist_ok=True)
+	output_paths = [output_directory / f"{stem}_clean-{i:03d}{'.csv' if format == CSV_FORMAT else ''}" for i in range(len(combinations))]
+
+	if workers > 1:
+		with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep, initargs=(ellipses, min_likelihood)) as executor:
+			stats = list(executor.map(_sweep_combination, combinations, repeat(quantile_backend), output_paths, repeat(format)))
+	else:
+		_init_sweep(ellipses, min_likelihood)
+		stats = [_sweep_combination(combination, quantile_backend, output_path, format) for combination, output_path in zip(combinations, output_paths)]
+
+	summary = pd.DataFrame([{"file": output_path.name, "rows": len(ellipses), **combination, **combination_stats} for output_path, combination, combination_stats in zip(output_paths, combinations, stats)])
+	summary_path = output_directory / f"{stem}-summary.csv"
+	summary.to_csv(summary_path, index=False)
+
+	logging.info(f"Sweep summary:\n{summary}")
+	logging.info(f"Written {len(combinations)} clean files and the summary: {summary_path}")
+
+
+def main():
+	import pandas as pd
+	import numpy as np
+
+	file, likelihood, min_percentile, max_percentile, radius_max_percentile, radius_min_percentile, eyeblink, n, window, clamp_mode, rolling, workers, chunk_size, quantile_backend, cache_dir, sweep_file, format, live, poll_interval, live_timeout = parse_cli()
+
+	output_path = clean_path(Path(__file__).parent / ".." / "clean", Path(file).stem, format)
+
+	if live:
+		# the same as seed-peaks.py names peaks of the clean file
+		peaks_path = Path(__file__).parent / ".." / "peaks" / f"{Path(file).stem}-peaks.yaml"
+		if peaks_path.exists():
+			logging.critical(f"Peaks file {peaks_path} exists, it may be curated and will not be overwritten")
+			exit(1)
+		peaks_path.parent.mkdir(parents=True, exist_ok=True)
+
+		logging.info(f"Following {file}, writing to CSV: {output_path}, peaks to: {peaks_path}")
+		sanitize_live(file, likelihood, min_percentile, max_percentile, radius_max_percentile, radius_min_percentile, window, rolling, output_path, peaks_path, poll_interval, live_timeout)
+		return
+
+	if sweep_file is not None:
+		combinations = read_sweep(sweep_file, {
+			"likelihood": likelihood,
+			"min_percentile": min_percentile,
+			"max_percentile": max_percentile,
+			"radius_min_percentile": radius_min_percentile,
+			"radius_max_percentile": radius_max_percentile,
+			"window": window,
+			"clamp_mode": clamp_mode,
+			"rolling": rolling,
+		})
+		data = read_dlc_csv(file, nrows=None if n == 0 else n)
+		logging.info(f"Parsed CSV (n = {len(data['x'])})")
+		sanitize_sweep(data, combinations, workers, quantile_backend, Path(__file__).parent / ".." / "clean" / f"{Path(file).stem}-sweep", Path(file).stem, format)
+		return
+
+	# fitted ellipses are cached, so that re-running with different parameters of later stages skips the fitting
+	cache_paths = None if cache_dir is None else ellipses_cache_paths(cache_dir, file, likelihood, n)
+
+	if chunk_size > 0:
+		sanitize_streaming(file, None if n == 0 else n, chunk_size, likelihood, min_percentile, max_percentile, radius_max_percentile, radius_min_percentile, window, clamp_mode, rolling, workers, quantile_backend, cache_paths, output_path, format)
+		logging.info(f"Written to {format.upper()}: {output_path}")
+		return
+
+	if cache_paths is not None and is_ellipses_cached(cache_paths):
+		frame = pd.DataFrame(np.load(cache_paths[0]), columns=ELLIPSE_COLUMNS)
+
+		logging.info(f"Read ellipses from cache: {cache_paths[0]} (n = {len(frame.index)})")
+	else:
+		data = read_dlc_csv(file, nrows=None if n == 0 else n)
+
+		logging.info(f"Parsed CSV (n = {len(data['x'])})")
+
+		frame, low_likelihood = read_ellipses(data, likelihood, workers)
+
+		logging.info("Converted to ellipses")
+
+		if cache_paths is not None:
+			write_ellipses_cache(cache_paths, frame.to_numpy(dtype=np.float64), low_likelihood)
+
+	stats = sanitize(frame, min_percentile, max_percentile, radius_max_percentile, radius_min_percentile, window, clamp_mode, rolling, quantile_backend)
+
+	logging.debug(f"Rows affected by every stage: {stats}")
+
+	write_clean(frame, output_path, format)
 
-	logging.info(f"Written to CSV: {output_path}")
+	logging.info(f"Written to {format.upper()}: {output_path}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Seeds peaks files for every session of the clean directory that has none, without opening the interactive plot.
+
+Inputs:
+	1. Clean directory (CSV files or directories of .npy files, possibly grouped in <mouse>-clean/ directories)
+	2. Peaks directory
+Output:
+	1. A peaks file for every session that has none, <mouse>-peaks/<name>-peaks.yaml for <mouse>-clean/<name>_clean.csv
+
+Peaks are found the same way interactive.py finds them for a session with no peaks file,
+so the seeded files are what interactive.py would start from; open them there to curate.
+"""
+
+import argparse
+import coloredlogs, logging
+import os
+from pathlib import Path
+from peaks import seed_peaks
+from utility import HORIZONTAL_TAG, VERTICAL_TAG, HIGH_TYPE, LOW_TYPE, logger, _tag, find_clean_sessions, read_clean_columns, PeakStore, update_peaks_file
+
+
+def parse_cli():
+
+	def is_valid_workers(parser, arg):
+		if not arg.isnumeric() or int(arg) < 1:
+			parser.error(f"Invalid value {arg}, must be a positive number")
+		return int(arg)
+
+	# All input that is needed
+	parser = argparse.ArgumentParser(description="Seed peaks -- finds peaks of every clean session that has no peaks file yet, in a pool of processes")
+	parser.add_argument("-v", dest="verbose", default=False, help="increase output verbosity", action="store_true")
+	parser.add_argument("--clean-dir", dest="clean_dir", type=str, default=str(Path(__file__).parent / ".." / "clean"), help="path to the directory of clean data files to walk.")
+	parser.add_argument("--peaks-dir", dest="peaks_dir", type=str, default=str(Path(__file__).parent / ".." / "peaks"), help="path to the directory of peaks files to write.")
+	parser.add_argument("--workers", dest="workers", type=lambda x: is_valid_workers(parser, x), default=os.cpu_count(), help="Number of processes to find peaks with. One per CPU in default")
+
+	args = parser.parse_args()
+
+	if not Path(args.clean_dir).is_dir():
+		parser.error(f"The directory {args.clean_dir} does not exist!")
+
+	# enable colored logs
+	coloredlogs.install(level=logging.DEBUG if args.verbose else logging.INFO, logger=logger)
+
+	return Path(args.clean_dir), Path(args.peaks_dir), args.workers
+
+
+def seed_session(data_path, peaks_path):
+	"""Find the peaks of the session and write its peaks file, return the number of peaks"""
+
+	columns = read_clean_columns(data_path, [HORIZONTAL_TAG, VERTICAL_TAG], mmap=True)
+
+	peaks = {}
+	for tag, (highs, lows) in seed_peaks(columns).items():
+		peaks[_tag(tag, HIGH_TYPE)] = highs
+		peaks[_tag(tag, LOW_TYPE)] = lows
+	peaks = PeakStore(peaks)
+
+	peaks_path.parent.mkdir(parents=True, exist_ok=True)
+	update_peaks_file(peaks, peaks_path)
+
+	return len(peaks)
+
+
+def main():
+	from concurrent.futures import ProcessPoolExecutor, as_completed
+
+	clean_directory, peaks_directory, workers = parse_cli()
+
+	sessions = find_clean_sessions(clean_directory, peaks_directory)
+
+	# curated (or already seeded) peaks are never overwritten
+	pending = []
+	for data_path, peaks_path in sessions:
+		if peaks_path.exists():
+			logger.debug(f"Skipped, peaks exist: {peaks_path}")
+		else:
+			pending += [(data_path, peaks_path)]
+
+	logger.info(f"Found {len(sessions)} sessions, {len(sessions) - len(pending)} have peaks, seeding {len(pending)} with {workers} workers")
+
+	failed = 0
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(seed_session, data_path, peaks_path): (data_path, peaks_path) for data_path, peaks_path in pending}
+		for future in as_completed(futures):
+			data_path, peaks_path = futures[future]
+			try:
+				logger.info(f"Seeded {future.result()} peaks: {peaks_path}")
+			except Exception as exception:
+				logger.error(f"Could not seed peaks of {data_path}: {exception}")
+				failed += 1
+
+	logger.info(f"Seeded {len(pending) - failed} peaks files")
+	if failed > 0:
+		logger.critical(f"{failed} sessions failed")
+		exit(1)
+
+
+if __name__ == "__main__":
+	main()
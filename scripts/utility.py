@@ -8,6 +8,16 @@ RATIO_TAG = "radius_ratio"
 HIGH_TYPE = "high"
 LOW_TYPE = "low"
 
+# formats of clean files: text CSV, or a directory with a .npy file per column (can be memory mapped)
+CSV_FORMAT = "csv"
+NPY_FORMAT = "npy"
+# files of the npy format that hold the frame numbers and the names of the columns (in order)
+NPY_INDEX = "_index.npy"
+NPY_COLUMNS = "_columns.txt"
+# total size of the cache directory (peaks seed_peaks finds, ellipses sanitizer.py fits), the least recently used entries are removed above it
+CACHE_BYTES = 2**30
+CACHE_PATTERNS = ["*-peaks.npz", "*-ellipses.npy", "*-likelihood.npy"]
+
 logger = logging.getLogger(__name__)
 
 
@@ -24,6 +34,459 @@ def is_valid_file(parser, arg):
 		return arg
 
 
+def read_dlc_header(path):
+	"""
+	Read the three header rows of a DeepLabCut CSV (scorer, bodyparts, coords).
+
+	Returns a list of (bodypart, coord) for every column of the file (the first, index column, is (None, None)),
+	and the number of header rows (the data starts right after the coords row).
+	"""
+	import csv
+
+	with open(path, "r", newline="") as dlc_file:
+		reader = csv.reader(dlc_file)
+		rows = {}
+		for row in reader:
+			rows[row[0]] = row
+			if row[0] == "coords":
+				break
+
+	if "bodyparts" not in rows or "coords" not in rows:
+		raise ValueError(f"{path} is not a DeepLabCut CSV, expected scorer, bodyparts and coords header rows")
+
+	return [(None, None)] + list(zip(rows["bodyparts"][1:], rows["coords"][1:])), len(rows)
+
+
+def _dlc_positions(path, header, bodyparts, coords):
+	"""Resolve the body parts (all of the file if None) and the column position of every (bodypart, coord) in the header"""
+	if bodyparts is None:
+		bodyparts = list(dict.fromkeys(bodypart for bodypart, _ in header[1:]))
+
+	positions = {}
+	for bodypart in bodyparts:
+		for coord in coords:
+			if (bodypart, coord) not in header:
+				raise ValueError(f"{path} has no {coord} column for body part '{bodypart}'")
+			positions[(bodypart, coord)] = header.index((bodypart, coord))
+
+	return bodyparts, positions
+
+
+def _dlc_dtype(coord, dtype):
+	"""The dtype to read the coord with, the likelihood is compared with thresholds and keeps full precision"""
+	return "float64" if coord == "likelihood" else dtype
+
+
+def read_dlc_csv(path, bodyparts=None, coords=("x", "y", "likelihood"), nrows=None, chunksize=None, dtype="float32"):
+	"""
+	Read a DeepLabCut CSV, loading only the columns of the given body parts and coordinates.
+
+	Body parts are resolved by name from the header, all body parts of the file (in file order) if not given.
+	Returns a dictionary mapping every coord to a contiguous (N, len(bodyparts)) NumPy array of dtype.
+	The likelihood is always float64, so that it compares with the (float64) threshold the same as before.
+	If chunksize is given, returns an iterator of such dictionaries instead, one per chunk of rows.
+	"""
+	import numpy as np
+	import pandas as pd
+
+	header, header_length = read_dlc_header(path)
+	bodyparts, positions = _dlc_positions(path, header, bodyparts, coords)
+
+	columns = sorted(positions.values())
+	reader = pd.read_csv(
+		path,
+		header=None,
+		skiprows=header_length,
+		usecols=columns,
+		dtype={position: _dlc_dtype(coord, dtype) for (_, coord), position in positions.items()},
+		engine="c",
+		nrows=nrows,
+		chunksize=chunksize,
+	)
+
+	def to_arrays(frame):
+		return {coord: np.ascontiguousarray(frame[[positions[(bodypart, coord)] for bodypart in bodyparts]].to_numpy(dtype=_dlc_dtype(coord, dtype))) for coord in coords}
+
+	if chunksize is not None:
+		return map(to_arrays, reader)
+	return to_arrays(reader)
+
+
+def tail_dlc_csv(path, bodyparts=None, coords=("x", "y", "likelihood"), poll_interval=1.0, timeout=None, dtype="float32"):
+	"""
+	Follow a DeepLabCut CSV that is still being written (e.g. during recording), the same as read_dlc_csv reads a whole one.
+
+	Yields a dictionary of arrays (as read_dlc_csv returns) for every batch of complete rows appended since the last one,
+	checking for new rows every poll_interval seconds.
+	Stops once no rows were appended for timeout seconds (follows forever if None), a last row with no line break is read then.
+	Batches are at most about a megabyte of rows (e.g. if the file is long already), only the unfinished last line is kept between them.
+	"""
+	import io
+	import time
+	import numpy as np
+	import pandas as pd
+
+	header, header_length = read_dlc_header(path)
+	bodyparts, positions = _dlc_positions(path, header, bodyparts, coords)
+	columns = sorted(positions.values())
+
+	def to_arrays(lines):
+		frame = pd.read_csv(io.BytesIO(lines), header=None, usecols=columns, dtype={position: _dlc_dtype(coord, dtype) for (_, coord), position in positions.items()}, engine="c")
+		return {coord: np.ascontiguousarray(frame[[positions[(bodypart, coord)] for bodypart in bodyparts]].to_numpy(dtype=_dlc_dtype(coord, dtype))) for coord in coords}
+
+	with open(path, "rb") as dlc_file:
+		for _ in range(header_length):
+			dlc_file.readline()
+
+		unfinished = b""
+		idle_since = time.monotonic()
+		while True:
+			appended = dlc_file.read(1 << 20)
+			if len(appended) > 0:
+				unfinished += appended
+				end = unfinished.rfind(b"\n") + 1
+				if end > 0:
+					lines, unfinished = unfinished[:end], unfinished[end:]
+					idle_since = time.monotonic()
+					if len(lines.strip()) > 0:
+						yield to_arrays(lines)
+					continue
+
+			if timeout is not None and time.monotonic() - idle_since > timeout:
+				break
+			time.sleep(poll_interval)
+
+	if len(unfinished.strip()) > 0:
+		yield to_arrays(unfinished)
+
+
+def clean_path(directory, stem, format=CSV_FORMAT):
+	"""Path of the clean file with the stem in the directory: a CSV file, or a directory of .npy files"""
+	from pathlib import Path
+
+	return Path(directory) / (f"{stem}_clean.csv" if format == CSV_FORMAT else f"{stem}_clean")
+
+
+def write_clean(frame, path, format=CSV_FORMAT, start=0, length=None):
+	"""
+	Write the clean frame (sanitizer.py) in the format, replacing the file if exists.
+
+	Can also write a long frame in parts: the part that starts at row start (0 for the first part) is appended.
+	The npy format needs the total number of rows (length) to write parts, the files are allocated with the first part.
+	"""
+	import numpy as np
+	from pathlib import Path
+
+	if format == CSV_FORMAT:
+		frame.to_csv(path, mode="w" if start == 0 else "a", header=start == 0)
+		return
+
+	path = Path(path)
+	length = len(frame.index) if length is None else length
+	columns = {NPY_INDEX: frame.index.to_numpy(dtype=np.int64)}
+	columns.update({f"{column}.npy": frame[column].to_numpy(dtype=np.float64) for column in frame.columns})
+
+	if start == 0:
+		path.mkdir(parents=True, exist_ok=True)
+		for stale in path.glob("*.npy"):
+			stale.unlink()
+		with open(path / NPY_COLUMNS, "w") as columns_file:
+			columns_file.write("".join(f"{column}\n" for column in frame.columns))
+
+	for name, values in columns.items():
+		array = np.lib.format.open_memmap(path / name, mode="w+" if start == 0 else "r+", dtype=values.dtype, shape=(length, ))
+		array[start:start + len(values)] = values
+		array.flush()
+		del array
+
+
+def read_clean(path, columns=None, start=0, stop=None, mmap=False):
+	"""
+	Read the clean file (sanitizer.py) in any format, the format is detected from the path (directory of .npy files or CSV).
+
+	Loads only the given columns (all if None) of rows [start, stop), the frame is indexed by frame numbers.
+	With mmap, columns of the npy format are memory mapped (read-only) rather than read.
+	"""
+	import numpy as np
+	import pandas as pd
+	from pathlib import Path
+
+	path = Path(path)
+
+	if path.is_dir():
+		if columns is None:
+			with open(path / NPY_COLUMNS, "r") as columns_file:
+				columns = columns_file.read().split()
+		arrays = {}
+		for column in [NPY_INDEX] + [f"{column}.npy" for column in columns]:
+			if not (path / column).exists():
+				raise ValueError(f"{path} has no column {Path(column).stem}")
+			arrays[column] = np.load(path / column, mmap_mode="r" if mmap else None)[start:stop]
+		index = arrays.pop(NPY_INDEX)
+		return pd.DataFrame({Path(column).stem: values for column, values in arrays.items()}, index=index, copy=False)
+
+	header = pd.read_csv(path, nrows=0).columns
+	if columns is None:
+		columns = list(header[1:])
+	for column in columns:
+		if column not in header:
+			raise ValueError(f"{path} has no column {column}")
+
+	# the first column of a clean CSV is the frame number
+	frame = pd.read_csv(
+		path,
+		index_col=0,
+		usecols=[0] + [header.get_loc(column) for column in columns],
+		skiprows=range(1, start + 1),
+		nrows=None if stop is None else max(0, stop - start),
+		engine="c",
+	)
+	frame.index.name = None
+	return frame[columns]
+
+
+def read_clean_columns(path, columns, mmap=False):
+	"""
+	Read the given columns of the clean file (sanitizer.py) as a dict of numpy arrays, in order of frames.
+
+	No frame is built, so with mmap the columns of the npy format stay memory mapped (a frame would copy them).
+	A CSV cannot be mapped, only the given columns are read.
+	"""
+	import numpy as np
+	from pathlib import Path
+
+	path = Path(path)
+
+	if path.is_dir():
+		arrays = {}
+		for column in columns:
+			if not (path / f"{column}.npy").exists():
+				raise ValueError(f"{path} has no column {column}")
+			arrays[column] = np.load(path / f"{column}.npy", mmap_mode="r" if mmap else None)
+		return arrays
+
+	frame = read_clean(path, columns=columns)
+	return {column: frame[column].to_numpy(dtype=np.float64) for column in columns}
+
+
+def find_clean_sessions(clean_directory, peaks_directory):
+	"""
+	Return (data file, peaks file) pairs of all clean sessions in the directory (recursively).
+
+	A session is a name_clean.csv file or a name_clean directory of .npy files (sweeps of sanitizer.py are not sessions).
+	Its peaks file mirrors the path in the peaks directory, with <mouse>-clean/ directories mapped to <mouse>-peaks/.
+	"""
+	from pathlib import Path
+
+	clean_directory = Path(clean_directory)
+	peaks_directory = Path(peaks_directory)
+
+	data_paths = list(clean_directory.rglob("*_clean.csv"))
+	data_paths += [path for path in clean_directory.rglob("*_clean") if path.is_dir() and (path / NPY_COLUMNS).exists()]
+
+	sessions = []
+	for data_path in sorted(data_paths):
+		directories = [part.removesuffix("-clean") + "-peaks" if part.endswith("-clean") else part for part in data_path.parent.relative_to(clean_directory).parts]
+		name = data_path.name.removesuffix(".csv").removesuffix("_clean")
+		sessions += [(data_path, peaks_directory.joinpath(*directories, f"{name}-peaks.yaml"))]
+
+	return sessions
+
+
+class PeakStore:
+	"""
+	Peaks (frame numbers) of every tag and type, e.g. x0_high.
+
+	Peaks of each tag and type are kept as a sorted list without duplicates,
+	so membership and range queries, as well as adding and removing a peak, are done by bisection.
+	Duplicates in the given peaks are merged (and logged), the merged ones are kept in duplicates, e.g. for angles.py to count them.
+	"""
+
+	def __init__(self, peaks=None):
+		"""Create the store from a dictionary that maps tag_type keys (e.g. x0_high) to lists or arrays of peaks"""
+		import collections
+
+		self.peaks = {}
+		# every extra occurrence of a peak in the given peaks, by tag_type key
+		self.duplicates = {}
+		for tag in [HORIZONTAL_TAG, VERTICAL_TAG]:
+			for type in [HIGH_TYPE, LOW_TYPE]:
+				counts = collections.Counter(int(value) for value in ([] if peaks is None else peaks[_tag(tag, type)]))
+				self.peaks[_tag(tag, type)] = sorted(counts)
+				self.duplicates[_tag(tag, type)] = sorted(value for value, count in counts.items() for _ in range(count - 1))
+				if len(self.duplicates[_tag(tag, type)]) > 0:
+					logger.warning(f"Duplicate {_tag(tag, type)} peaks merged: {self.duplicates[_tag(tag, type)]}")
+
+	def __getitem__(self, key):
+		"""Sorted peaks of the tag_type key as a NumPy array"""
+		import numpy as np
+
+		return np.array(self.peaks[key], dtype=np.int64)
+
+	def __len__(self):
+		return sum(len(values) for values in self.peaks.values())
+
+	def to_lists(self):
+		"""Dictionary that maps tag_type keys to sorted lists of peaks (e.g. to write YAML)"""
+		return {key: list(values) for key, values in self.peaks.items()}
+
+	def contains(self, tag, type, peak):
+		from bisect import bisect_left
+
+		values = self.peaks[_tag(tag, type)]
+		position = bisect_left(values, peak)
+		return position < len(values) and values[position] == peak
+
+	def is_peak(self, tag, peak):
+		"""Whether the frame is a high or low peak of the tag"""
+		return self.contains(tag, HIGH_TYPE, peak) or self.contains(tag, LOW_TYPE, peak)
+
+	def add(self, tag, type, peak):
+		from bisect import insort
+
+		if not self.contains(tag, type, peak):
+			insort(self.peaks[_tag(tag, type)], int(peak))
+
+	def remove(self, tag, type, peak):
+		from bisect import bisect_left
+
+		if self.contains(tag, type, peak):
+			values = self.peaks[_tag(tag, type)]
+			del values[bisect_left(values, peak)]
+
+	def toggle(self, tag, type, peak):
+		"""Remove the peak if exists, add otherwise; return True if the peak was added"""
+		if self.contains(tag, type, peak):
+			self.remove(tag, type, peak)
+			return False
+		self.add(tag, type, peak)
+		return True
+
+	def in_range(self, tag, type, left, right):
+		"""Sorted peaks within [left, right] as a NumPy array"""
+		import numpy as np
+		from bisect import bisect_left, bisect_right
+
+		values = self.peaks[_tag(tag, type)]
+		return np.array(values[bisect_left(values, left):bisect_right(values, right)], dtype=np.int64)
+
+
+def evict_cache(cache_dir, keep=(), max_bytes=CACHE_BYTES):
+	"""
+	Remove the least recently used entries of the cache directory (by modification time) until they take at most max_bytes.
+
+	Entries in keep (the ones just written) are never removed.
+	"""
+	from pathlib import Path
+
+	entries = []
+	for pattern in CACHE_PATTERNS:
+		for path in Path(cache_dir).glob(pattern):
+			try:
+				stat = path.stat()
+			except FileNotFoundError:
+				# removed by another process meanwhile
+				continue
+			entries += [(stat.st_mtime, stat.st_size, path)]
+
+	keep = [Path(path) for path in keep]
+	total = sum(size for _, size, _ in entries)
+	for _, size, path in sorted(entries):
+		if total <= max_bytes:
+			break
+		if path in keep:
+			continue
+		path.unlink(missing_ok=True)
+		total -= size
+
+
+def update_peaks_file(peaks, peaks_file_path):
+	"""
+	Write peaks (PeakStore) to the file given by the path.
+	Will overwrite the file if exists (atomically, the file is written next to it and renamed).
+	The temporary file has a unique name, so concurrent writers of the same file do not remove each other's.
+	"""
+	import yaml
+	import tempfile
+	from pathlib import Path
+
+	peaks_path = Path(peaks_file_path)
+
+	with tempfile.NamedTemporaryFile("w", encoding="utf8", dir=peaks_path.parent, prefix=f"{peaks_path.name}.", suffix=".tmp", delete=False) as peaks_file:
+		try:
+			yaml.dump(peaks.to_lists(), peaks_file, default_flow_style=False, allow_unicode=True)
+		except BaseException:
+			peaks_file.close()
+			os.unlink(peaks_file.name)
+			raise
+	# temporary files are private, the peaks file keeps its mode (or is readable by all, as files open() creates)
+	os.chmod(peaks_file.name, peaks_path.stat().st_mode & 0o777 if peaks_path.exists() else 0o644)
+	os.replace(peaks_file.name, peaks_path)
+
+
+class SegmentIndex:
+	"""
+	Segments (see peaks_to_segments) of one tag of a PeakStore, sorted by start.
+
+	Every segment keeps a value computed once by the given function of start and end (e.g. a color), None if not given.
+	When a peak is added or removed, only the segments between its neighbouring peaks are computed again.
+	Segments do not overlap, so both starts and ends are sorted, and range queries are done by bisection.
+	"""
+
+	def __init__(self, peaks, tag, value=None):
+		self.peaks = peaks
+		self.tag = tag
+		self.value = value if value is not None else lambda start, end: None
+		self.starts = []
+		self.ends = []
+		self.values = []
+		for start, end in peaks_to_segments(peaks.peaks[_tag(tag, HIGH_TYPE)], peaks.peaks[_tag(tag, LOW_TYPE)]):
+			self.starts += [start]
+			self.ends += [end]
+			self.values += [self.value(start, end)]
+
+	def __len__(self):
+		return len(self.starts)
+
+	def in_range(self, left, right):
+		"""List of (start, end, value) of segments within [left, right]"""
+		from bisect import bisect_left, bisect_right
+
+		first = bisect_left(self.starts, left)
+		last = bisect_right(self.ends, right)
+		return [(self.starts[i], self.ends[i], self.values[i]) for i in range(first, last)]
+
+	def update(self, peak):
+		"""Update segments after the peak (of any type) of the tag was added to or removed from the peak store"""
+		from bisect import bisect_left, bisect_right
+
+		# the closest peaks of any type before and after the edited one, segments between them may have changed
+		before, after = [], []
+		for type in [HIGH_TYPE, LOW_TYPE]:
+			values = self.peaks.peaks[_tag(self.tag, type)]
+			position = bisect_left(values, peak)
+			if position > 0:
+				before += [values[position - 1]]
+			position = bisect_right(values, peak)
+			if position < len(values):
+				after += [values[position]]
+		lower = max(before) if len(before) > 0 else peak
+		upper = min(after) if len(after) > 0 else peak
+
+		first = bisect_left(self.starts, lower)
+		last = max(first, bisect_right(self.ends, upper))
+		# values of segments that did not change are reused
+		known = {(self.starts[i], self.ends[i]): self.values[i] for i in range(first, last)}
+
+		highs = self.peaks.in_range(self.tag, HIGH_TYPE, lower, upper).tolist()
+		lows = self.peaks.in_range(self.tag, LOW_TYPE, lower, upper).tolist()
+		segments = peaks_to_segments(highs, lows)
+
+		self.starts[first:last] = [start for start, _ in segments]
+		self.ends[first:last] = [end for _, end in segments]
+		self.values[first:last] = [known[segment] if segment in known else self.value(*segment) for segment in segments]
+
+
 def peaks_to_segments(highs, lows):
 	"""
 	Derive full segments from the lists of high and low peaks.